@@ -1,17 +1,27 @@
+import itertools
 import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
 from config import (
     GENERATIVE_MODEL_NAME,
     EMBEDDING_MODEL_NAME,
     MATCH_THRESHOLD,
-    MATCH_COUNT
+    MATCH_COUNT,
+    EMBEDDING_CACHE_SIZE,
+    EMBEDDING_CACHE_PATH,
+    RESPONSE_CACHE_SIZE,
+    MAX_CHAT_MESSAGES
 )
 from services import (
     OllamaEmbeddingModel,
+    CachedEmbeddingModel,
     PostgresVectorStore,
-    GeminiGenerativeModel
+    GeminiGenerativeModel,
+    RegexFilterExtractor
 )
-from rag import RagPipeline
+from rag import RagPipeline, NO_MATCHES_MESSAGE
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -23,18 +33,41 @@ st.set_page_config(
 
 # --- Client Initialization ---
 
+def warm_up_embedding_model(embedding_model):
+    """Embeds a throwaway string so Ollama loads the model before the first query."""
+    try:
+        embedding_model.embed("warm up")
+        logging.info("Embedding model warmed up.")
+    except Exception as e:
+        logging.warning(f"Embedding model warm-up failed: {e}")
+
 @st.cache_resource
 def init_rag_pipeline():
     """Initializes and returns the RAG pipeline."""
     logging.info("Initializing RAG pipeline...")
-    embedding_model = OllamaEmbeddingModel(EMBEDDING_MODEL_NAME)
-    vector_store = PostgresVectorStore()
-    generative_model = GeminiGenerativeModel(GENERATIVE_MODEL_NAME)
+    # The clients are independent and I/O-bound, so they are set up concurrently
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        embedding_future = executor.submit(OllamaEmbeddingModel, EMBEDDING_MODEL_NAME)
+        vector_store_future = executor.submit(PostgresVectorStore)
+        generative_future = executor.submit(GeminiGenerativeModel, GENERATIVE_MODEL_NAME)
+        embedding_model = embedding_future.result()
+        vector_store = vector_store_future.result()
+        # Common price phrasings are parsed locally; Gemini handles the rest
+        generative_model = RegexFilterExtractor(generative_future.result())
+
+    # Load the embedding model in the background while the page renders
+    threading.Thread(target=warm_up_embedding_model, args=(embedding_model,), daemon=True).start()
+
+    # Query embeddings persist across restarts; the warm-up above bypasses the cache
+    if EMBEDDING_CACHE_PATH:
+        embedding_model = CachedEmbeddingModel(embedding_model, EMBEDDING_MODEL_NAME, EMBEDDING_CACHE_PATH)
     
     pipeline = RagPipeline(
         embedding_model=embedding_model,
         vector_store=vector_store,
-        generative_model=generative_model
+        generative_model=generative_model,
+        embedding_cache_size=EMBEDDING_CACHE_SIZE,
+        response_cache_size=RESPONSE_CACHE_SIZE
     )
     logging.info("RAG pipeline initialized successfully.")
     return pipeline
@@ -46,9 +79,9 @@ st.sidebar.markdown("[Read the Code on GitHub](https://github.com/jansenzjh/hote
 st.title("🏙️ Tokyo Hotel & Airbnb Chatbot")
 st.caption(f"Powered by Local PostgreSQL, {EMBEDDING_MODEL_NAME} model, and {GENERATIVE_MODEL_NAME} model")
 
-# Initialize chat history
+# Initialize chat history (bounded, so older turns drop off instead of growing every rerun)
 if "messages" not in st.session_state:
-    st.session_state.messages = []
+    st.session_state.messages = deque(maxlen=MAX_CHAT_MESSAGES)
     logging.info("Initialized new chat session.")
 
 # Initialize RAG pipeline
@@ -71,16 +104,28 @@ if prompt := st.chat_input("Ask me about hotels in Tokyo (eg. 'hotel in shinjuku
     # Display assistant response in chat message container
     with st.chat_message("assistant"):
         # Get the last 2 messages for history
-        chat_history = st.session_state.messages[-2:]
+        messages = st.session_state.messages
+        chat_history = list(itertools.islice(messages, max(0, len(messages) - 2), None))
         
-        response_stream = st.write_stream(
-            rag_pipeline.get_rag_response(
+        # Progress lives in an ephemeral status widget; only the answer is streamed and stored
+        with st.status("Working...", expanded=True) as status:
+            rag_prompt = rag_pipeline.build_prompt(
                 user_query=prompt,
                 chat_history=chat_history,
                 match_threshold=MATCH_THRESHOLD,
-                match_count=MATCH_COUNT
+                match_count=MATCH_COUNT,
+                on_status=lambda label: status.update(label=label)
             )
-        )
+            if rag_prompt is None:
+                status.update(label="No matches found", state="complete", expanded=False)
+            else:
+                status.update(label="Found matches! Asking the AI...", state="complete", expanded=False)
+
+        if rag_prompt is None:
+            response_stream = NO_MATCHES_MESSAGE
+            st.markdown(response_stream)
+        else:
+            response_stream = st.write_stream(rag_pipeline.stream_tokens(rag_prompt))
     logging.info(f"Assistant response: {response_stream}")
         
     # Add assistant response to chat history
@@ -14,15 +14,36 @@ DB_PORT = os.environ.get("DB_PORT", "5432")
 DB_NAME = os.environ.get("DB_NAME", "airbnb")
 DB_USER = os.environ.get("DB_USER", "postgres")
 DB_PASSWORD = os.environ.get("DB_PASSWORD", "postgres")
+DB_POOL_MIN_CONNECTIONS = 2  # Search connections kept open by the app
+DB_POOL_MAX_CONNECTIONS = 10  # Upper bound for concurrent searches
 
 GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
 
 # --- Model Configuration ---
 # --- Model Configuration ---
-EMBEDDING_MODEL_NAME = 'nomic-embed-text'
+# Override to run a quantized build of the same model, e.g. 'hf.co/nomic-ai/nomic-embed-text-v1.5-GGUF:Q8_0'
+EMBEDDING_MODEL_NAME = os.environ.get("EMBEDDING_MODEL_NAME", 'nomic-embed-text')
 VECTOR_DIMENSION = 768  # Vector dimension for nomic-embed-text
+# Optional CPU thread count for the Ollama embedding runner (defaults to Ollama's own choice)
+EMBEDDING_NUM_THREAD = os.environ.get("EMBEDDING_NUM_THREAD")
+EMBEDDING_OPTIONS = {"num_thread": int(EMBEDDING_NUM_THREAD)} if EMBEDDING_NUM_THREAD else None
 GENERATIVE_MODEL_NAME = 'gemini-2.5-flash-lite'
 
+# --- Ollama Client ---
+OLLAMA_HOST = os.environ.get("OLLAMA_HOST")  # None falls back to Ollama's default of localhost:11434
+# Comma-separated Ollama servers the ingestion script spreads embedding batches across
+OLLAMA_HOSTS = [host.strip() for host in os.environ.get("OLLAMA_HOSTS", "").split(",") if host.strip()] or [OLLAMA_HOST]
+OLLAMA_TIMEOUT = 120  # Seconds; large ingestion batches can take a while on CPU
+
 # --- RAG Parameters ---
 MATCH_THRESHOLD = 0.5  # Similarity threshold
 MATCH_COUNT = 5        # Number of documents to retrieve
+EMBEDDING_CACHE_SIZE = 1024  # Number of query embeddings kept in memory
+# Embeddings persisted across restarts; set to an empty string to disable
+EMBEDDING_CACHE_PATH = os.environ.get("EMBEDDING_CACHE_PATH", ".embedding_cache.sqlite")
+EMBEDDING_CACHE_MAX_ENTRIES = 50_000  # Oldest persisted embeddings are evicted past this (~3 KB each)
+RESPONSE_CACHE_SIZE = 256  # Number of generated answers kept in memory
+SEARCH_CACHE_SIZE = 256  # Number of vector search results kept in memory
+SEARCH_CACHE_TTL = 600  # Seconds a cached search result is served, so re-ingested listings show up
+FILTER_CACHE_SIZE = 2048  # Number of extracted query filters kept in memory
+MAX_CHAT_MESSAGES = 50  # Messages kept (and redisplayed) per chat session
@@ -1,85 +1,319 @@
-import os
+import io
+import itertools
 import json
+import os
+from math import isfinite
+import queue
+import random
+import struct
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import httpx
+import numpy as np
+import orjson
 import psycopg2
 import ollama
 from dotenv import load_dotenv
-from config import DB_HOST, DB_NAME, DB_USER, DB_PASSWORD, DB_PORT, EMBEDDING_MODEL_NAME
+from config import (
+    DB_HOST, DB_NAME, DB_USER, DB_PASSWORD, DB_PORT,
+    EMBEDDING_MODEL_NAME, EMBEDDING_OPTIONS, OLLAMA_HOSTS, OLLAMA_TIMEOUT
+)
 
 # --- Configuration ---
 load_dotenv()  # Load environment variables from .env file
 
 INPUT_FILE = 'clean_listings.jsonl'
+READ_BUFFER_SIZE = 1 << 20  # Read the input file in 1 MiB chunks
 TABLE_NAME = 'listings'
-BATCH_SIZE = 50  # Number of listings to process and upload at a time
+STAGING_TABLE_NAME = 'listings_staging'  # Temporary table that COPY loads into before merging
+MERGE_STATEMENT_NAME = 'merge_listings'  # Prepared INSERT ... SELECT out of the staging table
+BATCH_SIZE = 500  # Number of listings to upload per COPY
+EMBED_BATCH_SIZE = 50  # Number of listings to embed per Ollama request
+SORT_WINDOW = 8 * EMBED_BATCH_SIZE  # Listings sorted by document length before being split into embed batches
+EMBED_BATCH_MAX_CHARS = 150_000  # Caps the text per Ollama request, so batches of long documents are split
+PREFETCH_LINES = 4 * BATCH_SIZE  # Parsed listings the reader thread may hold ahead of the main loop
+EMBED_WORKERS = 8 * len(OLLAMA_HOSTS)  # Concurrent embedding requests; 8 per host, matching each server's OLLAMA_NUM_PARALLEL
+MAX_IN_FLIGHT_BATCHES = 4 * EMBED_WORKERS  # Bounds memory held by batches waiting to be uploaded
 EMBEDDING_MODEL = EMBEDDING_MODEL_NAME # Use model from config
+TRUNCATION_LENGTHS = [8000, 4000, 1000, 500]  # Character limits tried when a text exceeds the context length
+EMBED_RETRIES = 3  # Attempts per embed request when Ollama is unreachable or overloaded
+TRANSIENT_STATUS_CODES = {429, 502, 503, 504}  # Ollama answers 503 when its request queue is full
+INDEX_NAME = 'idx_listings_embedding_half_ip_hnsw'  # HNSW index from init_db.sql, rebuilt after loading
+INDEX_MAINTENANCE_WORK_MEM = '2GB'  # Memory for the index build; lower this on small servers
+INDEX_PARALLEL_WORKERS = 7  # Parallel workers for the index build
 # --- End Configuration ---
 
-def get_embedding(text: str, model_name: str) -> list[float] | None:
-    """Generates an embedding for the given text using the Ollama model.
-       Retries with truncation if the context length is exceeded.
+# One client per Ollama host, shared by the embedding workers so requests reuse keep-alive
+# connections. Batches are handed to the hosts round-robin.
+ollama_clients = [ollama.Client(host=host, timeout=OLLAMA_TIMEOUT) for host in OLLAMA_HOSTS]
+
+def parse_listing(line: bytes) -> dict | None:
+    """Parses one JSONL line with orjson, returning None if it is not valid JSON.
+       Files written with json.dump (like the bundled clean_listings.jsonl) store missing
+       values as bare NaN, which strict JSON parsers reject. Those lines fall back to the
+       json module, which maps NaN/Infinity tokens (never string contents) to null.
     """
-    if not text or not isinstance(text, str) or len(text.strip()) == 0:
-        print("Warning: Skipping empty or invalid text.")
+    try:
+        return orjson.loads(line)
+    except orjson.JSONDecodeError:
+        pass
+    try:
+        return json.loads(line, parse_constant=lambda constant: None)
+    except ValueError:
         return None
 
-    # Try with different lengths: Full -> 4000 -> 1000 -> 500
-    lengths_to_try = [8000, 4000, 1000, 500]
 
-    for length in lengths_to_try:
+def _read_listings(path: str, out_queue: queue.Queue):
+    """Reader thread: parses the JSONL file into `out_queue` so disk reads and parsing
+       overlap with embedding and uploads. Ends with a None sentinel.
+    """
+    try:
+        with open(path, 'rb', buffering=READ_BUFFER_SIZE) as f:
+            for i, line in enumerate(f):
+                out_queue.put((i, parse_listing(line)))
+    except Exception as e:
+        out_queue.put(e)
+    finally:
+        out_queue.put(None)
+
+
+def iter_listings(path: str):
+    """Yields (line index, listing) pairs read ahead on a background thread.
+       The listing is None for lines that could not be parsed.
+    """
+    parsed_listings = queue.Queue(maxsize=PREFETCH_LINES)
+    threading.Thread(target=_read_listings, args=(path, parsed_listings), daemon=True).start()
+    while (item := parsed_listings.get()) is not None:
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+def _is_context_length_error(error: Exception) -> bool:
+    """Checks whether an Ollama error was caused by an input that is too long (likely 500 status code)."""
+    error_msg = str(error).lower()
+    return "500" in error_msg or "context length" in error_msg
+
+
+def _is_transient_error(error: Exception) -> bool:
+    """Checks whether an Ollama request failed for a reason worth retrying as is:
+       the server could not be reached, dropped the connection, timed out or was too
+       busy to accept it.
+    """
+    if isinstance(error, ollama.ResponseError):
+        return error.status_code in TRANSIENT_STATUS_CODES
+    # The client only wraps connect failures; timeouts and dropped connections surface
+    # as httpx transport errors
+    return isinstance(error, (ConnectionError, httpx.TransportError))
+
+
+def _embed_batch(client: ollama.Client, texts: list[str], model_name: str, length_index: int = 0) -> list[list[float] | None]:
+    """Embeds a batch of texts with a single Ollama request.
+       On context length errors the batch is bisected so long texts don't fail the
+       short ones; a single text that still fails is retried with a shorter truncation.
+       Requests that fail because Ollama is unreachable or busy are retried with backoff.
+    """
+    length = TRUNCATION_LENGTHS[length_index]
+    for attempt in range(EMBED_RETRIES):
         try:
-            truncated_text = text[:length]
-            response = ollama.embeddings(model=model_name, prompt=truncated_text)
-            return response["embedding"]
+            response = client.embed(model=model_name, input=[text[:length] for text in texts], options=EMBEDDING_OPTIONS)
+            return response["embeddings"]
         except Exception as e:
-            # Check if it's a context length error (likely 500 status code)
-            error_msg = str(e).lower()
-            if "500" in error_msg or "context length" in error_msg:
-                print(f"Warning: Embedding failed with length {length}. Retrying with truncation...")
-                continue # Try next shorter length
-            else:
-                # Actual error (e.g. connection lost), stop trying
-                print(f"Error generating embedding for text: {text[:50]}...")
+            if _is_transient_error(e) and attempt < EMBED_RETRIES - 1:
+                # Jittered exponential backoff (1-2s, then 2-3s) so the workers don't retry in lockstep
+                delay = 2 ** attempt + random.random()
+                print(f"Warning: Embedding request failed ({e}). Retrying in {delay:.1f}s...")
+                time.sleep(delay)
+                continue
+            if not _is_context_length_error(e):
+                # Actual error (e.g. connection lost for good), stop trying
+                print(f"Error generating embeddings for batch of {len(texts)} texts.")
                 print(f"Error: {e}")
-                return None
-    
-    print(f"Failed to embed even after truncation to {lengths_to_try[-1]} chars.")
-    return None
+                return [None] * len(texts)
+            break
 
+    if len(texts) > 1:
+        middle = len(texts) // 2
+        return (_embed_batch(client, texts[:middle], model_name, length_index)
+                + _embed_batch(client, texts[middle:], model_name, length_index))
 
-def sanitize_record(record: dict) -> dict:
-    """Replaces NaN/inf float values with None for JSON compliance."""
-    for key, value in record.items():
-        if isinstance(value, float) and (value != value or value == float('inf') or value == float('-inf')):
-            record[key] = None
-    return record
+    if length_index + 1 < len(TRUNCATION_LENGTHS):
+        print(f"Warning: Embedding failed with length {length}. Retrying with truncation...")
+        return _embed_batch(client, texts, model_name, length_index + 1)
 
+    print(f"Failed to embed even after truncation to {TRUNCATION_LENGTHS[-1]} chars.")
+    return [None]
 
-def upload_batch(conn, batch: list[dict]):
-    """Uploads a batch of listings to the Postgres table."""
+
+def finite_float(value) -> float | None:
+    """Casts a value to float, mapping NaN/inf to None so they are stored as NULL."""
+    value = float(value)
+    return value if isfinite(value) else None
+
+
+# Listings table columns filled from the listing's JSON key of the same name:
+# (column, caster applied to non-null values, default when the key is missing)
+COLUMNS = (
+    ('id', None, None),
+    ('listing_url', None, ''),
+    ('last_scraped', None, ''),
+    ('source', None, ''),
+    ('name', None, ''),
+    ('description', None, ''),
+    ('neighborhood_overview', None, ''),
+    ('host_url', None, ''),
+    ('host_name', None, ''),
+    ('host_since', None, ''),
+    ('host_location', None, ''),
+    ('host_about', None, ''),
+    ('host_response_time', None, ''),
+    ('host_response_rate', None, ''),
+    ('host_acceptance_rate', None, ''),
+    ('host_is_superhost', None, ''),
+    ('host_neighbourhood', None, ''),
+    ('host_listings_count', int, 0),
+    ('host_total_listings_count', int, 0),
+    ('host_verifications', None, ''),
+    ('host_has_profile_pic', None, ''),
+    ('host_identity_verified', None, ''),
+    ('neighbourhood', None, ''),
+    ('neighbourhood_cleansed', None, ''),
+    ('neighbourhood_group_cleansed', None, ''),
+    ('latitude', finite_float, 0.0),
+    ('longitude', finite_float, 0.0),
+    ('property_type', None, ''),
+    ('room_type', None, ''),
+    ('accommodates', int, 0),
+    ('bathrooms', finite_float, 0.0),
+    ('bathrooms_text', None, ''),
+    ('bedrooms', finite_float, 0.0),
+    ('beds', finite_float, 0.0),
+    ('amenities', None, ''),
+    ('price_cleaned', finite_float, 0.0),
+    ('minimum_nights', int, 0),
+    ('maximum_nights', int, 0),
+    ('minimum_minimum_nights', int, 0),
+    ('maximum_minimum_nights', int, 0),
+    ('minimum_maximum_nights', int, 0),
+    ('maximum_maximum_nights', int, 0),
+    ('minimum_nights_avg_ntm', finite_float, 0.0),
+    ('maximum_nights_avg_ntm', finite_float, 0.0),
+    ('calendar_updated', None, ''),
+    ('has_availability', None, ''),
+    ('availability_30', int, 0),
+    ('availability_60', int, 0),
+    ('availability_90', int, 0),
+    ('availability_365', int, 0),
+    ('calendar_last_scraped', None, ''),
+    ('number_of_reviews', int, 0),
+    ('number_of_reviews_ltm', int, 0),
+    ('number_of_reviews_l30d', int, 0),
+    ('review_scores_rating', finite_float, 0.0),
+    ('review_scores_accuracy', finite_float, 0.0),
+    ('review_scores_cleanliness', finite_float, 0.0),
+    ('review_scores_checkin', finite_float, 0.0),
+    ('review_scores_communication', finite_float, 0.0),
+    ('review_scores_location', finite_float, 0.0),
+    ('review_scores_value', finite_float, 0.0),
+    ('license', None, ''),
+    ('instant_bookable', None, ''),
+    ('calculated_host_listings_count', int, 0),
+    ('calculated_host_listings_count_entire_homes', int, 0),
+    ('calculated_host_listings_count_private_rooms', int, 0),
+    ('calculated_host_listings_count_shared_rooms', int, 0),
+    ('reviews_per_month', finite_float, 0.0),
+)
+# Column order of every row; rag_document and the embedding are appended per listing
+COLUMN_NAMES = tuple(column for column, _, _ in COLUMNS) + ('rag_document', 'embedding')
+COLUMNS_SQL = ', '.join(COLUMN_NAMES)
+# Postgres binary COPY framing: signature, flags and header extension length, then an end-of-data marker
+COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+COPY_TRAILER = struct.pack('!h', -1)
+COPY_NULL = struct.pack('!i', -1)
+
+# Binary encoders keyed by the Postgres type name of each column
+FIELD_ENCODERS = {
+    'int8': lambda value: struct.pack('!q', value),
+    'int4': lambda value: struct.pack('!i', value),
+    'float8': lambda value: struct.pack('!d', value),
+    'text': lambda value: str(value).encode('utf-8'),
+    # pgvector wire format: dimension, unused flags, then big-endian float4 values
+    'vector': lambda value: struct.pack('!HH', len(value), 0) + np.asarray(value, dtype='>f4').tobytes(),
+}
+
+
+def get_field_encoders(conn) -> list:
+    """Looks up the Postgres type of every column and returns their binary encoders
+       in COLUMN_NAMES order.
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT a.attname, t.typname
+            FROM pg_attribute a JOIN pg_type t ON t.oid = a.atttypid
+            WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped
+            """,
+            (TABLE_NAME,)
+        )
+        column_types = dict(cur.fetchall())
+    return [FIELD_ENCODERS[column_types[c]] for c in COLUMN_NAMES]
+
+
+def fetch_existing_ids(conn) -> set:
+    """Returns the ids already in the table, so a rerun only embeds new listings."""
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT id FROM {TABLE_NAME}")
+        return {row[0] for row in cur}
+
+
+def encode_copy_binary(batch: list[tuple], encoders: list) -> bytes:
+    """Encodes a batch of rows in Postgres' binary COPY format."""
+    field_count = struct.pack('!h', len(encoders))
+
+    parts = [COPY_HEADER]
+    for row in batch:
+        parts.append(field_count)
+        for value, encode in zip(row, encoders):
+            if value is None:
+                parts.append(COPY_NULL)
+            else:
+                data = encode(value)
+                parts.append(struct.pack('!i', len(data)))
+                parts.append(data)
+    parts.append(COPY_TRAILER)
+    return b''.join(parts)
+
+
+def prepare_upload(conn, cur):
+    """Creates the session's staging table and prepares the merge out of it, so each
+       batch only streams its rows and executes the already-parsed statement.
+    """
+    # Staging rows are cleared automatically when each batch's transaction commits
+    cur.execute(f"CREATE TEMP TABLE IF NOT EXISTS {STAGING_TABLE_NAME} (LIKE {TABLE_NAME}) ON COMMIT DELETE ROWS")
+    cur.execute(
+        f"PREPARE {MERGE_STATEMENT_NAME} AS "
+        f"INSERT INTO {TABLE_NAME} ({COLUMNS_SQL}) SELECT {COLUMNS_SQL} FROM {STAGING_TABLE_NAME} ON CONFLICT (id) DO NOTHING"
+    )
+    conn.commit()
+
+
+def upload_batch(conn, cur, batch: list[tuple], encoders: list):
+    """Uploads a batch of listings to the Postgres table.
+       Rows are streamed with binary COPY into the staging table from `prepare_upload`,
+       then merged so existing listings are still skipped via ON CONFLICT.
+    """
     if not batch:
         return 0
     
     try:
-        with conn.cursor() as cur:
-            # Assuming all records have the same keys (which they update below)
-            # We get columns from the first record
-            columns = list(batch[0].keys())
-            
-            # Construct the SQL query dynamically
-            # INSERT INTO table (col1, col2) VALUES (%s, %s) ON CONFLICT (id) DO NOTHING
-            cols_str = ', '.join(columns)
-            placeholders = ', '.join(['%s'] * len(columns))
-            sql = f"INSERT INTO {TABLE_NAME} ({cols_str}) VALUES ({placeholders}) ON CONFLICT (id) DO NOTHING"
-            
-            # Prepare values
-            values = [tuple(record[c] for c in columns) for record in batch]
-            
-            cur.executemany(sql, values)
-            conn.commit()
-            
-            print(f"Successfully uploaded batch of {len(batch)} listings.")
-            return len(batch)
+        copy_data = encode_copy_binary(batch, encoders)
+        cur.copy_expert(f"COPY {STAGING_TABLE_NAME} ({COLUMNS_SQL}) FROM STDIN WITH (FORMAT BINARY)", io.BytesIO(copy_data))
+        cur.execute(f"EXECUTE {MERGE_STATEMENT_NAME}")
+        conn.commit()
+
+        print(f"Successfully uploaded batch of {len(batch)} listings.")
+        return len(batch)
 
     except Exception as e:
         conn.rollback() # Rollback in case of error
@@ -87,6 +321,136 @@ def upload_batch(conn, batch: list[dict]):
         return 0
 
 
+def drop_vector_index(conn):
+    """Drops the HNSW index so bulk loads don't pay per-row index maintenance."""
+    with conn.cursor() as cur:
+        cur.execute(f"DROP INDEX IF EXISTS {INDEX_NAME}")
+    conn.commit()
+
+
+def build_vector_index(conn):
+    """(Re)builds the HNSW index in one pass once all listings are loaded, then refreshes
+       the planner statistics so searches use the index and the price filters are costed
+       against the new rows.
+    """
+    print(f"\nBuilding index {INDEX_NAME}...")
+    create_index = (
+        f"CREATE INDEX IF NOT EXISTS {INDEX_NAME} ON {TABLE_NAME} "
+        "USING hnsw (embedding_half halfvec_ip_ops) WITH (m = 24, ef_construction = 128)"
+    )
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"SET maintenance_work_mem = '{INDEX_MAINTENANCE_WORK_MEM}'")
+            cur.execute(f"SET max_parallel_maintenance_workers = {INDEX_PARALLEL_WORKERS}")
+            cur.execute(create_index)
+    except Exception as e:
+        # A parallel build needs maintenance_work_mem of shared memory, which small
+        # servers and containers may not have; a serial build with the defaults still works
+        conn.rollback()
+        print(f"Warning: Parallel index build failed ({e}). Retrying with a serial build...")
+        with conn.cursor() as cur:
+            cur.execute("RESET maintenance_work_mem")
+            cur.execute("SET max_parallel_maintenance_workers = 0")
+            cur.execute(create_index)
+    with conn.cursor() as cur:
+        cur.execute(f"ANALYZE {TABLE_NAME}")
+    conn.commit()
+    print("Index built successfully.")
+
+
+def normalize_embeddings(embeddings: list[list[float]]) -> np.ndarray:
+    """Scales a batch of embeddings to unit length so the inner product index ranks by
+       cosine similarity. The batch shares one array, already in pgvector's big-endian
+       float4 layout, so encoding each row for COPY is a plain byte copy.
+    """
+    vectors = np.array(embeddings, dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12
+    return vectors.astype('>f4')
+
+
+def build_row(listing: dict, embedding: np.ndarray) -> tuple:
+    """Maps a listing's JSON keys to a row in COLUMN_NAMES order."""
+    row = []
+    for key, caster, default in COLUMNS:
+        value = listing.get(key, default)
+        row.append(value if caster is None or value is None else caster(value))
+    row.append(listing['rag_document'])
+    row.append(embedding)
+    return tuple(row)
+
+
+def embed_listings(client: ollama.Client, listings: list[dict]) -> list[list[float] | None]:
+    """Worker task: embeds a batch of listings' rag_documents in one request to `client`.
+       Identical documents in the batch are sent once and share the result. Batches
+       arrive sorted by length from submit_embed_batches, so they are sent as is.
+    """
+    texts = [listing['rag_document'] for listing in listings]
+    unique_texts = list(dict.fromkeys(texts))
+    embeddings = dict(zip(unique_texts, _embed_batch(client, unique_texts, EMBEDDING_MODEL)))
+    return [embeddings[text] for text in texts]
+
+
+def submit_embed_batches(executor, futures: dict, listings: list[dict], clients):
+    """Sorts a window of listings by document length and submits it in batches of up to
+       EMBED_BATCH_SIZE listings and EMBED_BATCH_MAX_CHARS characters. Similar-length
+       documents share a request, so batches take a similar time and the few over-long
+       documents land together, where a context length error only bisects their batch.
+       Each batch goes to the next client from the `clients` iterator.
+    """
+    batch, batch_chars = [], 0
+    for listing in sorted(listings, key=lambda listing: len(listing['rag_document'])):
+        # Truncation caps what is actually sent per document
+        chars = min(len(listing['rag_document']), TRUNCATION_LENGTHS[0])
+        if batch and (len(batch) >= EMBED_BATCH_SIZE or batch_chars + chars > EMBED_BATCH_MAX_CHARS):
+            futures[executor.submit(embed_listings, next(clients), batch)] = batch
+            batch, batch_chars = [], 0
+        batch.append(listing)
+        batch_chars += chars
+    if batch:
+        futures[executor.submit(embed_listings, next(clients), batch)] = batch
+
+
+def collect_completed(futures: dict, done, rows: list[tuple]) -> int:
+    """Builds DB rows for the batches whose embedding futures have completed and
+       appends them to `rows`. `futures` maps each future to its listings; completed
+       entries are removed. Returns the number of listings that failed.
+    """
+    failed = 0
+    for future in done:
+        listings = futures.pop(future)
+        try:
+            embeddings = future.result()
+        except Exception as e:
+            print(f"An unexpected error occurred embedding a batch of {len(listings)} listings: {e}")
+            failed += len(listings)
+            continue
+
+        embedded = []
+        for listing, embedding in zip(listings, embeddings):
+            if embedding is None:
+                print(f"Warning: Failed to embed listing {listing.get('id')}.")
+                failed += 1
+                continue
+            embedded.append((listing, embedding))
+        if not embedded:
+            continue
+
+        try:
+            vectors = normalize_embeddings([embedding for _, embedding in embedded])
+        except Exception as e:
+            print(f"An unexpected error occurred preparing a batch of {len(embedded)} listings: {e}")
+            failed += len(embedded)
+            continue
+
+        for (listing, _), vector in zip(embedded, vectors):
+            try:
+                rows.append(build_row(listing, vector))
+            except Exception as e:
+                print(f"An unexpected error occurred preparing listing {listing.get('id')}: {e}")
+                failed += 1
+    return failed
+
+
 def main():
     """Main script to process and upload data."""
     
@@ -100,137 +464,97 @@ def main():
             password=DB_PASSWORD,
             port=DB_PORT
         )
+        encoders = get_field_encoders(conn)
+        existing_ids = fetch_existing_ids(conn)
+        cur = conn.cursor()  # Reused by every batch upload
+        prepare_upload(conn, cur)
         print("Connected to PostgreSQL successfully.")
+        if existing_ids:
+            print(f"Found {len(existing_ids)} listings already in {TABLE_NAME}; they will be skipped.")
     except Exception as e:
         print(f"Error connecting to database: {e}")
+        if conn:
+            conn.close()
         return
 
     print("Starting data processing...")
 
     # 2. Open input file and process in batches
+    pending_listings = []
     listings_batch = []
     total_success = 0
     total_failed = 0
+    total_skipped = 0
+
+    # Embedding runs on a worker pool; uploads stay on this thread since they share `conn`
+    executor = ThreadPoolExecutor(max_workers=EMBED_WORKERS)
+    in_flight = {}  # future -> listings being embedded
+    clients = itertools.cycle(ollama_clients)
+    index_dropped = False
+
+    def upload(batch: list[tuple]) -> int:
+        """Uploads a batch, dropping the vector index just before the first rows are written,
+           so a run with nothing new to load leaves the index alone.
+        """
+        nonlocal index_dropped
+        if not index_dropped:
+            drop_vector_index(conn)
+            index_dropped = True
+        return upload_batch(conn, cur, batch, encoders)
 
     try:
-        with open(INPUT_FILE, 'r', encoding='utf-8') as f:
-            for i, line in enumerate(f):
-                try:
-                    listing = json.loads(line)
-                    text_to_embed = listing.get('rag_document')
-                    
-                    if not text_to_embed:
-                        print(f"Warning: Skipping listing {listing.get('id')} - no rag_document.")
-                        total_failed += 1
-                        continue
-
-                    # 3. Generate Embedding
-                    embedding = get_embedding(text_to_embed, EMBEDDING_MODEL)
-                    
-                    if embedding is None:
-                        print(f"Warning: Failed to embed listing {listing.get('id')}.")
-                        total_failed += 1
-                        continue
-
-                    # 4. Prepare the final DB record
-                    # This maps our JSON keys to the exact SQL table column names
-                    db_record = {
-                        'id': listing.get('id'),
-                        'listing_url': listing.get('listing_url', ''),
-                        'last_scraped': listing.get('last_scraped', ''),
-                        'source': listing.get('source', ''),
-                        'name': listing.get('name', ''),
-                        'description': listing.get('description', ''),
-                        'neighborhood_overview': listing.get('neighborhood_overview', ''),
-                        'host_url': listing.get('host_url', ''),
-                        'host_name': listing.get('host_name', ''),
-                        'host_since': listing.get('host_since', ''),
-                        'host_location': listing.get('host_location', ''),
-                        'host_about': listing.get('host_about', ''),
-                        'host_response_time': listing.get('host_response_time', ''),
-                        'host_response_rate': listing.get('host_response_rate', ''),
-                        'host_acceptance_rate': listing.get('host_acceptance_rate', ''),
-                        'host_is_superhost': listing.get('host_is_superhost', ''),
-                        'host_neighbourhood': listing.get('host_neighbourhood', ''),
-                        'host_listings_count': int(listing.get('host_listings_count', 0)),
-                        'host_total_listings_count': int(listing.get('host_total_listings_count', 0)),
-                        'host_verifications': listing.get('host_verifications', ''),
-                        'host_has_profile_pic': listing.get('host_has_profile_pic', ''),
-                        'host_identity_verified': listing.get('host_identity_verified', ''),
-                        'neighbourhood': listing.get('neighbourhood', ''),
-                        'neighbourhood_cleansed': listing.get('neighbourhood_cleansed', ''),
-                        'neighbourhood_group_cleansed': listing.get('neighbourhood_group_cleansed', ''),
-                        'latitude': float(listing.get('latitude', 0.0)),
-                        'longitude': float(listing.get('longitude', 0.0)),
-                        'property_type': listing.get('property_type', ''),
-                        'room_type': listing.get('room_type', ''),
-                        'accommodates': int(listing.get('accommodates', 0)),
-                        'bathrooms': float(listing.get('bathrooms', 0.0)),
-                        'bathrooms_text': listing.get('bathrooms_text', ''),
-                        'bedrooms': float(listing.get('bedrooms', 0.0)),
-                        'beds': float(listing.get('beds', 0.0)),
-                        'amenities': listing.get('amenities', ''),
-                        'price_cleaned': float(listing.get('price_cleaned', 0.0)),
-                        'minimum_nights': int(listing.get('minimum_nights', 0)),
-                        'maximum_nights': int(listing.get('maximum_nights', 0)),
-                        'minimum_minimum_nights': int(listing.get('minimum_minimum_nights', 0)),
-                        'maximum_minimum_nights': int(listing.get('maximum_minimum_nights', 0)),
-                        'minimum_maximum_nights': int(listing.get('minimum_maximum_nights', 0)),
-                        'maximum_maximum_nights': int(listing.get('maximum_maximum_nights', 0)),
-                        'minimum_nights_avg_ntm': float(listing.get('minimum_nights_avg_ntm', 0.0)),
-                        'maximum_nights_avg_ntm': float(listing.get('maximum_nights_avg_ntm', 0.0)),
-                        'calendar_updated': listing.get('calendar_updated', ''),
-                        'has_availability': listing.get('has_availability', ''),
-                        'availability_30': int(listing.get('availability_30', 0)),
-                        'availability_60': int(listing.get('availability_60', 0)),
-                        'availability_90': int(listing.get('availability_90', 0)),
-                        'availability_365': int(listing.get('availability_365', 0)),
-                        'calendar_last_scraped': listing.get('calendar_last_scraped', ''),
-                        'number_of_reviews': int(listing.get('number_of_reviews', 0)),
-                        'number_of_reviews_ltm': int(listing.get('number_of_reviews_ltm', 0)),
-                        'number_of_reviews_l30d': int(listing.get('number_of_reviews_l30d', 0)),
-                        'review_scores_rating': float(listing.get('review_scores_rating', 0.0)),
-                        'review_scores_accuracy': float(listing.get('review_scores_accuracy', 0.0)),
-                        'review_scores_cleanliness': float(listing.get('review_scores_cleanliness', 0.0)),
-                        'review_scores_checkin': float(listing.get('review_scores_checkin', 0.0)),
-                        'review_scores_communication': float(listing.get('review_scores_communication', 0.0)),
-                        'review_scores_location': float(listing.get('review_scores_location', 0.0)),
-                        'review_scores_value': float(listing.get('review_scores_value', 0.0)),
-                        'license': listing.get('license', ''),
-                        'instant_bookable': listing.get('instant_bookable', ''),
-                        'calculated_host_listings_count': int(listing.get('calculated_host_listings_count', 0)),
-                        'calculated_host_listings_count_entire_homes': int(listing.get('calculated_host_listings_count_entire_homes', 0)),
-                        'calculated_host_listings_count_private_rooms': int(listing.get('calculated_host_listings_count_private_rooms', 0)),
-                        'calculated_host_listings_count_shared_rooms': int(listing.get('calculated_host_listings_count_shared_rooms', 0)),
-                        'reviews_per_month': float(listing.get('reviews_per_month', 0.0)),
-                        'rag_document': text_to_embed,
-                        'embedding': embedding
-                    }
-                    
-                    listings_batch.append(sanitize_record(db_record))
-
-                    # 5. Upload batch when full
-                    if len(listings_batch) >= BATCH_SIZE:
-                        print(f"\nProcessing line {i+1}...")
-                        uploaded_count = upload_batch(conn, listings_batch)
-                        total_success += uploaded_count
-                        total_failed += (BATCH_SIZE - uploaded_count)
-                        listings_batch = []  # Clear the batch
-                        time.sleep(0.5) # Reduced sleep as local DB is faster
-
-                except json.JSONDecodeError:
+        for i, listing in iter_listings(INPUT_FILE):
+            try:
+                if listing is None:
                     print(f"Error decoding JSON on line {i+1}. Skipping.")
                     total_failed += 1
-                except Exception as e:
-                    print(f"An unexpected error occurred processing line {i+1}: {e}")
+                    continue
+
+                if not listing.get('rag_document'):
+                    print(f"Warning: Skipping listing {listing.get('id')} - no rag_document.")
                     total_failed += 1
+                    continue
+
+                # Skip listings uploaded by an earlier run before doing any embedding work
+                if listing.get('id') in existing_ids:
+                    total_skipped += 1
+                    continue
+
+                pending_listings.append(listing)
+
+                # 3. Submit batches for embedding once a sort window is full
+                if len(pending_listings) >= SORT_WINDOW:
+                    submit_embed_batches(executor, in_flight, pending_listings, clients)
+                    pending_listings = []  # Start a new window
+
+                # 4. Collect embedded batches, blocking only when too many are in flight
+                timeout = None if len(in_flight) >= MAX_IN_FLIGHT_BATCHES else 0
+                done, _ = wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+                total_failed += collect_completed(in_flight, done, listings_batch)
 
-            # 6. Upload any remaining listings in the last batch
-            if listings_batch:
-                print("\nUploading final batch...")
-                uploaded_count = upload_batch(conn, listings_batch)
-                total_success += uploaded_count
-                total_failed += (len(listings_batch) - uploaded_count)
+                # 5. Upload batch when full
+                if len(listings_batch) >= BATCH_SIZE:
+                    print(f"\nProcessing line {i+1}...")
+                    uploaded_count = upload(listings_batch)
+                    total_success += uploaded_count
+                    total_failed += (len(listings_batch) - uploaded_count)
+                    listings_batch = []  # Clear the batch
+
+            except Exception as e:
+                print(f"An unexpected error occurred processing line {i+1}: {e}")
+                total_failed += 1
+
+        # 6. Embed any remaining listings and upload the final batch
+        if pending_listings:
+            submit_embed_batches(executor, in_flight, pending_listings, clients)
+        done, _ = wait(in_flight)
+        total_failed += collect_completed(in_flight, done, listings_batch)
+
+        if listings_batch:
+            print("\nUploading final batch...")
+            uploaded_count = upload(listings_batch)
+            total_success += uploaded_count
+            total_failed += (len(listings_batch) - uploaded_count)
 
     except FileNotFoundError:
         print(f"Error: Input file '{INPUT_FILE}' not found.")
@@ -238,12 +562,20 @@ def main():
     except Exception as e:
         print(f"A fatal error occurred: {e}")
     finally:
-        if conn:
-            conn.close()
+        executor.shutdown(cancel_futures=True)
+        # Always restore a dropped index, even after a partial load
+        if index_dropped:
+            try:
+                build_vector_index(conn)
+            except Exception as e:
+                conn.rollback()
+                print(f"Error building index {INDEX_NAME}: {e}")
+        conn.close()
 
     print("\n--- Upload Complete ---")
     print(f"Total Successful: {total_success}")
     print(f"Total Failed: {total_failed}")
+    print(f"Total Skipped (already uploaded): {total_skipped}")
     print("------------------------")
 
 if __name__ == "__main__":
@@ -76,9 +76,24 @@ create table if not exists listings (
   embedding vector(768)
 );
 
+-- 2.5 Add a half-precision copy of the embedding for the ANN index
+-- (added separately so re-running this script upgrades existing tables)
+alter table listings add column if not exists embedding_half halfvec(768)
+  generated always as (embedding::halfvec(768)) stored;
+
+-- Embeddings are stored at unit length, so inner product ranks the same as cosine
+-- (normalizes rows loaded before ingest_data.py did this itself)
+update listings set embedding = l2_normalize(embedding)
+where embedding is not null and abs(vector_norm(embedding) - 1) > 1e-4;
+
+-- HNSW index over the half-precision copy: half the bytes to traverse per search
+-- (ingest_data.py drops and rebuilds it around bulk loads)
+create index if not exists idx_listings_embedding_half_ip_hnsw on listings
+  using hnsw (embedding_half halfvec_ip_ops) with (m = 24, ef_construction = 128);
+
 -- 3. Create a function to search for listings
 create or replace function match_properties (
-  query_embedding vector(768),
+  query_embedding vector(768), -- must be unit length
   match_threshold float,
   match_count int
 )
@@ -93,24 +108,41 @@ returns table (
   similarity float
 )
 language sql stable
+set hnsw.ef_search = 100
 as $$
+  -- Stage 1: approximate top candidates from the halfvec HNSW index
+  with candidates as (
+    select
+      listings.id,
+      listings.name,
+      listings.listing_url,
+      listings.latitude,
+      listings.longitude,
+      listings.rag_document,
+      listings.price_cleaned,
+      listings.embedding
+    from listings
+    order by listings.embedding_half <#> query_embedding::halfvec(768)
+    limit match_count * 4
+  )
+  -- Stage 2: rerank the candidates with the full-precision embedding
   select
-    listings.id,
-    listings.name,
-    listings.listing_url,
-    listings.latitude,
-    listings.longitude,
-    listings.rag_document,
-    listings.price_cleaned,
-    1 - (listings.embedding <=> query_embedding) as similarity
-  from listings
-  where 1 - (listings.embedding <=> query_embedding) > match_threshold
-  order by similarity desc
+    candidates.id,
+    candidates.name,
+    candidates.listing_url,
+    candidates.latitude,
+    candidates.longitude,
+    candidates.rag_document,
+    candidates.price_cleaned,
+    -(candidates.embedding <#> query_embedding) as similarity
+  from candidates
+  where -(candidates.embedding <#> query_embedding) > match_threshold
+  order by candidates.embedding <#> query_embedding
   limit match_count;
 $$;
 
 create or replace function match_properties_filtered (
-  query_embedding vector(768),
+  query_embedding vector(768), -- must be unit length
   match_threshold float,
   match_count int,
   min_price float default null,
@@ -127,20 +159,53 @@ returns table (
   similarity float
 )
 language sql stable
+set hnsw.ef_search = 100
 as $$
+  -- Stage 1 (unfiltered): approximate top candidates from the halfvec HNSW index
+  with candidates as (
+    select
+      listings.id,
+      listings.name,
+      listings.listing_url,
+      listings.latitude,
+      listings.longitude,
+      listings.rag_document,
+      listings.price_cleaned,
+      listings.embedding
+    from listings
+    where min_price is null and max_price is null
+    order by listings.embedding_half <#> query_embedding::halfvec(768)
+    limit match_count * 4
+  ),
+  -- Stage 1 (price filter): a selective filter would discard most HNSW candidates after
+  -- the scan and return short results, so filtered searches scan the matching rows exactly
+  filtered as (
+    select
+      listings.id,
+      listings.name,
+      listings.listing_url,
+      listings.latitude,
+      listings.longitude,
+      listings.rag_document,
+      listings.price_cleaned,
+      listings.embedding
+    from listings
+    where (min_price is not null or max_price is not null)
+    and (min_price is null or listings.price_cleaned >= min_price)
+    and (max_price is null or listings.price_cleaned <= max_price)
+  )
+  -- Stage 2: rank the candidates with the full-precision embedding
   select
-    listings.id,
-    listings.name,
-    listings.listing_url,
-    listings.latitude,
-    listings.longitude,
-    listings.rag_document,
-    listings.price_cleaned,
-    1 - (listings.embedding <=> query_embedding) as similarity
-  from listings
-  where 1 - (listings.embedding <=> query_embedding) > match_threshold
-  and (min_price is null or listings.price_cleaned >= min_price)
-  and (max_price is null or listings.price_cleaned <= max_price)
-  order by similarity desc
+    candidates.id,
+    candidates.name,
+    candidates.listing_url,
+    candidates.latitude,
+    candidates.longitude,
+    candidates.rag_document,
+    candidates.price_cleaned,
+    -(candidates.embedding <#> query_embedding) as similarity
+  from (select * from candidates union all select * from filtered) candidates
+  where -(candidates.embedding <#> query_embedding) > match_threshold
+  order by candidates.embedding <#> query_embedding
   limit match_count;
 $$;
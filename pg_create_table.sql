@@ -74,6 +74,14 @@ create table if not exists listings_1024 (
   rag_document text,
   embedding vector(1024)
 );
+
+alter table listings_1024 add column if not exists embedding_half halfvec(1024)
+  generated always as (embedding::halfvec(1024)) stored;
+
+-- HNSW index over the half-precision copy: half the bytes to traverse per search
+create index if not exists idx_listings_1024_embedding_half_hnsw on listings_1024
+  using hnsw (embedding_half halfvec_cosine_ops) with (m = 24, ef_construction = 128);
+
 -- 3. Create a function to search for listings
 create or replace function match_properties_1024 (
   query_embedding vector(1024),
@@ -91,18 +99,35 @@ returns table (
   similarity float
 )
 language sql stable
+set hnsw.ef_search = 100
 as $$
+  -- Stage 1: approximate top candidates from the halfvec HNSW index
+  with candidates as (
+    select
+      listings_1024.id,
+      listings_1024.name,
+      listings_1024.listing_url,
+      listings_1024.latitude,
+      listings_1024.longitude,
+      listings_1024.rag_document,
+      listings_1024.price_cleaned,
+      listings_1024.embedding
+    from listings_1024
+    order by listings_1024.embedding_half <=> query_embedding::halfvec(1024)
+    limit match_count * 4
+  )
+  -- Stage 2: rerank the candidates with the full-precision embedding
   select
-    listings_1024.id,
-    listings_1024.name,
-    listings_1024.listing_url,
-    listings_1024.latitude,
-    listings_1024.longitude,
-    listings_1024.rag_document,
-    listings_1024.price_cleaned,
-    1 - (listings_1024.embedding <=> query_embedding) as similarity
-  from listings_1024
-  where 1 - (listings_1024.embedding <=> query_embedding) > match_threshold
-  order by similarity desc
+    candidates.id,
+    candidates.name,
+    candidates.listing_url,
+    candidates.latitude,
+    candidates.longitude,
+    candidates.rag_document,
+    candidates.price_cleaned,
+    1 - (candidates.embedding <=> query_embedding) as similarity
+  from candidates
+  where 1 - (candidates.embedding <=> query_embedding) > match_threshold
+  order by candidates.embedding <=> query_embedding
   limit match_count;
 $$;
\ No newline at end of file
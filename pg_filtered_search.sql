@@ -16,20 +16,53 @@ returns table (
   similarity float
 )
 language sql stable
+set hnsw.ef_search = 100
 as $$
+  -- Stage 1 (unfiltered): approximate top candidates from the halfvec HNSW index
+  with candidates as (
+    select
+      listings_1024.id,
+      listings_1024.name,
+      listings_1024.listing_url,
+      listings_1024.latitude,
+      listings_1024.longitude,
+      listings_1024.rag_document,
+      listings_1024.price_cleaned,
+      listings_1024.embedding
+    from listings_1024
+    where min_price is null and max_price is null
+    order by listings_1024.embedding_half <=> query_embedding::halfvec(1024)
+    limit match_count * 4
+  ),
+  -- Stage 1 (price filter): a selective filter would discard most HNSW candidates after
+  -- the scan and return short results, so filtered searches scan the matching rows exactly
+  filtered as (
+    select
+      listings_1024.id,
+      listings_1024.name,
+      listings_1024.listing_url,
+      listings_1024.latitude,
+      listings_1024.longitude,
+      listings_1024.rag_document,
+      listings_1024.price_cleaned,
+      listings_1024.embedding
+    from listings_1024
+    where (min_price is not null or max_price is not null)
+    and (min_price is null or listings_1024.price_cleaned >= min_price)
+    and (max_price is null or listings_1024.price_cleaned <= max_price)
+  )
+  -- Stage 2: rank the candidates with the full-precision embedding
   select
-    listings_1024.id,
-    listings_1024.name,
-    listings_1024.listing_url,
-    listings_1024.latitude,
-    listings_1024.longitude,
-    listings_1024.rag_document,
-    listings_1024.price_cleaned,
-    1 - (listings_1024.embedding <=> query_embedding) as similarity
-  from listings_1024
-  where 1 - (listings_1024.embedding <=> query_embedding) > match_threshold
-  and (min_price is null or listings_1024.price_cleaned >= min_price)
-  and (max_price is null or listings_1024.price_cleaned <= max_price)
-  order by similarity desc
+    candidates.id,
+    candidates.name,
+    candidates.listing_url,
+    candidates.latitude,
+    candidates.longitude,
+    candidates.rag_document,
+    candidates.price_cleaned,
+    1 - (candidates.embedding <=> query_embedding) as similarity
+  from (select * from candidates union all select * from filtered) candidates
+  where 1 - (candidates.embedding <=> query_embedding) > match_threshold
+  order by candidates.embedding <=> query_embedding
   limit match_count;
 $$;
@@ -1,119 +1,277 @@
+import numpy as np
 import pandas as pd
 import re
+import os
 import json
+import ast
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import orjson
+
+WRITE_BUFFER_SIZE = 1 << 20  # Write the output file in 1 MiB chunks
+JSONL_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_APPEND_NEWLINE
+
+CHUNK_SIZE = 50_000  # Listings processed at a time, so memory use doesn't grow with the file
+# Chunks cleaned in parallel. Capped because every in-flight chunk holds a DataFrame and its
+# serialized JSONL, so memory grows with the worker count rather than the file
+PROCESS_WORKERS = min(os.cpu_count() or 1, 4)
+MAX_PENDING_CHUNKS = PROCESS_WORKERS + 1  # Bounds the chunks held in memory while writing
+# Columns read as float even in chunks without NaNs, so every chunk formats them the
+# same way: fractional values, plus the nights aggregates that have gaps in the source
+FLOAT_COLUMNS = [
+    'latitude', 'longitude', 'bathrooms', 'bedrooms', 'beds',
+    'minimum_minimum_nights', 'maximum_minimum_nights', 'minimum_maximum_nights',
+    'maximum_maximum_nights', 'minimum_nights_avg_ntm', 'maximum_nights_avg_ntm',
+    'review_scores_rating', 'review_scores_accuracy', 'review_scores_cleanliness',
+    'review_scores_checkin', 'review_scores_communication', 'review_scores_location',
+    'review_scores_value', 'reviews_per_month'
+]
+
+# Replacement for missing values, by column
+FILL_VALUES = (
+    {col: '' for col in [
+        'name', 'description', 'neighborhood_overview', 'host_about', 'host_name',
+        'host_location', 'host_neighbourhood', 'bathrooms_text', 'license', 'host_since',
+        'host_response_time', 'neighbourhood', 'neighbourhood_cleansed',
+        'neighbourhood_group_cleansed', 'property_type', 'room_type', 'amenities',
+        'host_verifications'
+    ]}
+    | {col: 'N/A' for col in ['host_response_rate', 'host_acceptance_rate']}
+    | {col: 'f' for col in [
+        'host_is_superhost', 'host_has_profile_pic', 'host_identity_verified',
+        'has_availability', 'instant_bookable'
+    ]}
+    | {col: 0 for col in [
+        'host_listings_count', 'host_total_listings_count', 'accommodates', 'bathrooms',
+        'bedrooms', 'beds', 'minimum_nights', 'maximum_nights', 'minimum_minimum_nights',
+        'maximum_minimum_nights', 'minimum_maximum_nights', 'maximum_maximum_nights',
+        'minimum_nights_avg_ntm', 'maximum_nights_avg_ntm', 'availability_30',
+        'availability_60', 'availability_90', 'availability_365', 'number_of_reviews',
+        'number_of_reviews_ltm', 'number_of_reviews_l30d', 'review_scores_rating',
+        'review_scores_accuracy', 'review_scores_cleanliness', 'review_scores_checkin',
+        'review_scores_communication', 'review_scores_location', 'review_scores_value',
+        'calculated_host_listings_count', 'calculated_host_listings_count_entire_homes',
+        'calculated_host_listings_count_private_rooms',
+        'calculated_host_listings_count_shared_rooms', 'reviews_per_month'
+    ]}
+)
+
+# Text columns with only a few dozen distinct values, kept as pandas categories
+CATEGORY_COLUMNS = [
+    'neighbourhood_cleansed', 'neighbourhood_group_cleansed', 'property_type',
+    'room_type', 'host_response_time'
+]
+
+# Price patterns, compiled once at import
+_PRICE_RE = re.compile(r"[^0-9.]")  # Characters that are not digits or a decimal point
+_NUMBER_RE = re.compile(r"\d+\.?\d*|\.\d+")  # Digit strings float() can parse
+
+def clean_prices(prices):
+    """
+    Cleans a Series of price strings like '$1,500.00' into floats like 1500.0.
+    Handles NaNs (empty values) and unparseable prices by returning 0.0.
+    """
+    # Remove characters that are not digits or a decimal point, in one pass over the column
+    cleaned = prices.astype(str).str.replace(_PRICE_RE, "", regex=True)
+    # Only digits with at most one decimal point parse; astype(float) matches float() exactly
+    parseable = cleaned.str.fullmatch(_NUMBER_RE).fillna(False).astype(bool)
+    return cleaned.where(parseable).astype(float).fillna(0.0)
 
 def clean_price(price_str):
     """
-    Cleans a price string like '$1,500.00' into a float '1500.0'.
+    Cleans a single price string like '$1,500.00' into a float '1500.0'.
     Handles NaNs (empty values) by returning 0.0.
     """
-    if pd.isna(price_str):
-        return 0.0
-    
-    # Remove '$', ',', and whitespace
-    try:
-        # Remove characters that are not digits or a decimal point
-        cleaned_str = re.sub(r"[^0-9.]", "", str(price_str))
-        if cleaned_str:
-            return float(cleaned_str)
-        else:
-            return 0.0
-    except ValueError:
-        return 0.0
+    return float(clean_prices(pd.Series([price_str], dtype=object)).iloc[0])
+
+def _column(df, name, default=None):
+    """
+    Returns a column, or a constant Series like `row.get(name, default)` if it's missing.
+    """
+    if name in df.columns:
+        return df[name]
+    return pd.Series(default, index=df.index, dtype=object)
 
-def create_rag_document(row):
+def _str(series):
     """
-    Combines structured data into a single text document
-    for embedding.
+    Formats every value like an f-string would, including missing values as 'nan'.
     """
-    doc_parts = []
+    return series.map(str)
+
+def _text(series):
+    """
+    Formats values as strings, leaving missing values as NaN so they can be masked out.
+    """
+    return series.astype(str).where(series.notna())
+
+def _flag_text(df, name, text, otherwise=None):
+    """
+    Returns `text` for rows where a 't'/'f' flag column is 't', and `otherwise` elsewhere.
+    """
+    return pd.Series(np.where(_column(df, name) == 't', text, otherwise), index=df.index)
+
+def _join_present(parts, sep):
+    """
+    Joins the non-missing values of several string Series row by row.
+    Rows where every part is missing stay NaN.
+    """
+    joined = parts[0]
+    for part in parts[1:]:
+        joined = (joined + sep + part).fillna(joined).fillna(part)
+    return joined
+
+def parse_amenities(amenities):
+    """
+    Parses an amenities list string like '["Wifi", "Kitchen"]'.
+    Uses the JSON parser, falling back to Python literal syntax for single-quoted lists.
+    Returns an empty list for missing or unparseable values.
+    """
+    if not isinstance(amenities, str) or amenities in ('', '[]'):
+        return []
+    try:
+        parsed = orjson.loads(amenities)
+    except orjson.JSONDecodeError:
+        try:
+            parsed = ast.literal_eval(amenities)
+        except Exception:
+            return []
+    return parsed if isinstance(parsed, list) else []
 
+def create_rag_documents(df):
+    """
+    Combines structured data into a single text document per listing
+    for embedding, building each part column-wise over the whole DataFrame.
+    Expects the 'amenities_str' column added during cleaning.
+    """
     # Name and description
-    doc_parts.append(f"Name: {row.get('name', 'N/A')}")
-    if pd.notna(row.get('description')):
-        doc_parts.append(f"Description: {row.get('description')}")
-    if pd.notna(row.get('neighborhood_overview')):
-        doc_parts.append(f"Neighborhood Overview: {row.get('neighborhood_overview')}")
+    doc = "Name: " + _str(_column(df, 'name', 'N/A'))
+    optional_parts = [
+        "Description: " + _text(_column(df, 'description')),
+        "Neighborhood Overview: " + _text(_column(df, 'neighborhood_overview')),
+    ]
 
     # Location
-    location_parts = []
-    if pd.notna(row.get('neighbourhood_cleansed')):
-        location_parts.append(row.get('neighbourhood_cleansed'))
-    if pd.notna(row.get('neighbourhood_group_cleansed')):
-        location_parts.append(row.get('neighbourhood_group_cleansed'))
-    if location_parts:
-        doc_parts.append(f"Location: {', '.join(location_parts)}")
+    location = _join_present(
+        [_text(_column(df, 'neighbourhood_cleansed')), _text(_column(df, 'neighbourhood_group_cleansed'))], ", "
+    )
+    optional_parts.append("Location: " + location)
 
     # Property details
-    property_details = []
-    if pd.notna(row.get('property_type')):
-        property_details.append(f"Property Type: {row.get('property_type')}")
-    if pd.notna(row.get('room_type')):
-        property_details.append(f"Room Type: {row.get('room_type')}")
-    if property_details:
-        doc_parts.append(". ".join(property_details) + ".")
-    
-    doc_parts.append(f"Accommodates: {row.get('accommodates', 1)} guest(s), with {row.get('bedrooms', 0)} bedroom(s) and {row.get('beds', 0)} bed(s). It has {row.get('bathrooms_text', 'a bathroom')}.")
+    property_details = _join_present([
+        "Property Type: " + _text(_column(df, 'property_type')),
+        "Room Type: " + _text(_column(df, 'room_type')),
+    ], ". ")
+    optional_parts.append(property_details + ".")
 
-    # Amenities
-    amenities = row.get('amenities', '[]')
-    if amenities and amenities != '[]':
-        try:
-            amenities_list = eval(amenities)
-            if isinstance(amenities_list, list) and len(amenities_list) > 0:
-                amenities_str = ", ".join(amenities_list)
-                doc_parts.append(f"Amenities include: {amenities_str}.")
-        except:
-            pass
+    optional_parts.append(
+        "Accommodates: " + _str(_column(df, 'accommodates', 1))
+        + " guest(s), with " + _str(_column(df, 'bedrooms', 0))
+        + " bedroom(s) and " + _str(_column(df, 'beds', 0))
+        + " bed(s). It has " + _str(_column(df, 'bathrooms_text', 'a bathroom')) + "."
+    )
+
+    # Amenities (parsed once during cleaning)
+    optional_parts.append("Amenities include: " + _column(df, 'amenities_str') + ".")
 
     # Host information
-    host_info = []
-    if pd.notna(row.get('host_name')):
-        host_info.append(f"The host is {row.get('host_name')}")
-    if pd.notna(row.get('host_since')):
-        host_info.append(f"hosting since {row.get('host_since')}")
-    if host_info:
-        doc_parts.append(", ".join(host_info) + ".")
-    
-    if row.get('host_is_superhost') == 't':
-        doc_parts.append("The host is a Superhost.")
-    
-    if pd.notna(row.get('host_about')):
-        doc_parts.append(f"About the host: {row.get('host_about')}")
+    host_info = _join_present([
+        "The host is " + _text(_column(df, 'host_name')),
+        "hosting since " + _text(_column(df, 'host_since')),
+    ], ", ")
+    optional_parts.append(host_info + ".")
+
+    optional_parts.append(_flag_text(df, 'host_is_superhost', "The host is a Superhost."))
+
+    optional_parts.append("About the host: " + _text(_column(df, 'host_about')))
 
     # Reviews
-    review_score = row.get('review_scores_rating', 0)
-    review_count = row.get('number_of_reviews', 0)
-    if review_count > 0:
-        doc_parts.append(f"It has a rating of {review_score:.2f}/5.00 from {review_count} reviews.")
+    review_score = _column(df, 'review_scores_rating', 0)
+    review_count = _column(df, 'number_of_reviews', 0)
+    reviews = (
+        "It has a rating of " + review_score.map('{:.2f}'.format)
+        + "/5.00 from " + _str(review_count) + " reviews."
+    )
+    optional_parts.append(reviews.where(review_count > 0))
 
     # Price
-    doc_parts.append(f"Price: Around {row.get('price_cleaned', 0)} JPY per night.")
+    optional_parts.append("Price: Around " + _str(_column(df, 'price_cleaned', 0)) + " JPY per night.")
 
     # Booking details
-    booking_details = []
-    booking_details.append(f"Minimum stay: {row.get('minimum_nights', 1)} night(s).")
-    if row.get('instant_bookable') == 't':
-        booking_details.append("Instant bookable is available.")
-    doc_parts.append(" ".join(booking_details))
+    booking_details = "Minimum stay: " + _str(_column(df, 'minimum_nights', 1)) + " night(s)."
+    booking_details += _flag_text(df, 'instant_bookable', " Instant bookable is available.", "")
+    optional_parts.append(booking_details)
 
-    return "\n".join(doc_parts)
+    for part in optional_parts:
+        doc += ("\n" + part).fillna("")
+    return doc
 
 
-def process_listings(input_csv='listings.csv', output_jsonl='clean_listings.jsonl'):
+def prepare_records(df, columns_to_keep):
     """
-    Main function to load, clean, and prepare data for Supabase.
+    Cleans one chunk of listings, adds its RAG documents and returns a
+    DataFrame of the output columns.
     """
-    print(f"Loading data from {input_csv}...")
-    try:
-        df = pd.read_csv(input_csv)
-    except FileNotFoundError:
-        print(f"Error: {input_csv} not found.")
-        print("Please download the 'listings.csv' from Kaggle and place it in this directory.")
-        return
+    available_columns = [col for col in columns_to_keep if col in df.columns]
+
+    # 2. Clean the structured data
+    df['price_cleaned'] = clean_prices(df['price'])
+    
+    # Handle missing values (NaNs) in a single pass; absent columns are skipped
+    df = df.fillna(FILL_VALUES)
+
+    # Low-cardinality text columns are stored as categories (small integer codes)
+    for col in CATEGORY_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+
+    # Parse the amenities lists once, joined for the RAG documents
+    if 'amenities' in df.columns:
+        amenities_list = df['amenities'].map(parse_amenities)
+        df['amenities_str'] = amenities_list.str.join(', ').where(amenities_list.str.len() > 0)
+
+    # 3. Create the RAG document for each listing
+    df['rag_document'] = create_rag_documents(df)
+    
+    # Select final columns for the output file
+    final_columns = available_columns + ['rag_document', 'price_cleaned']
+    if 'price' in final_columns:
+        final_columns.remove('price') # use price_cleaned instead
+    
+    # Ensure all final columns exist
+    return df[[col for col in final_columns if col in df.columns]]
+
 
-    print(f"Loaded {len(df)} listings.")
+def iter_records(df):
+    """
+    Yields each row of the DataFrame as a dict of plain Python values,
+    without building the whole list of records first.
+    """
+    columns = list(df.columns)
+    values = [df[col].tolist() for col in columns]
+    for row in zip(*values):
+        yield dict(zip(columns, row))
 
+
+def serialize_chunk(df, columns_to_keep):
+    """
+    Cleans one chunk in a worker process and returns its JSONL bytes,
+    the number of listings and the first record (or None).
+    """
+    final_df = prepare_records(df, columns_to_keep)
+    records = iter_records(final_df)
+    first_record = next(records, None)
+    if first_record is None:
+        return b'', 0, None
+    lines = [orjson.dumps(first_record, option=JSONL_OPTIONS)]
+    lines.extend(orjson.dumps(record, option=JSONL_OPTIONS) for record in records)
+    return b''.join(lines), len(final_df), first_record
+
+
+def process_listings(input_csv='listings.csv', output_jsonl='clean_listings.jsonl'):
+    """
+    Main function to load, clean, and prepare data for Supabase.
+    """
     # 1. Select the columns we care about
     columns_to_keep = [
         'id', 'listing_url', 'last_scraped', 'source', 'name', 'description', 
@@ -138,76 +296,58 @@ def process_listings(input_csv='listings.csv', output_jsonl='clean_listings.json
         'calculated_host_listings_count_private_rooms', 
         'calculated_host_listings_count_shared_rooms', 'reviews_per_month'
     ]
-    
-    available_columns = [col for col in columns_to_keep if col in df.columns]
-    print(f"Keeping {len(available_columns)} columns.")
-    df = df[available_columns]
-
-    # 2. Clean the structured data
-    print("Cleaning data...")
-    df['price_cleaned'] = df['price'].apply(clean_price)
-    
-    # Handle missing values (NaNs)
-    for col in ['name', 'description', 'neighborhood_overview', 'host_about', 'host_name', 'host_location', 'host_neighbourhood', 'bathrooms_text', 'license', 'host_since', 'host_response_time', 'neighbourhood', 'neighbourhood_cleansed', 'neighbourhood_group_cleansed', 'property_type', 'room_type', 'amenities', 'host_verifications']:
-        if col in df.columns:
-            df[col] = df[col].fillna('')
-            
-    for col in ['host_response_rate', 'host_acceptance_rate']:
-        if col in df.columns:
-            df[col] = df[col].fillna('N/A')
 
-    for col in ['host_is_superhost', 'host_has_profile_pic', 'host_identity_verified', 'has_availability', 'instant_bookable']:
-        if col in df.columns:
-            df[col] = df[col].fillna('f')
-
-    numeric_cols = [
-        'host_listings_count', 'host_total_listings_count', 'accommodates', 'bathrooms', 
-        'bedrooms', 'beds', 'minimum_nights', 'maximum_nights', 'minimum_minimum_nights', 
-        'maximum_minimum_nights', 'minimum_maximum_nights', 'maximum_maximum_nights', 
-        'minimum_nights_avg_ntm', 'maximum_nights_avg_ntm', 'availability_30', 
-        'availability_60', 'availability_90', 'availability_365', 'number_of_reviews', 
-        'number_of_reviews_ltm', 'number_of_reviews_l30d', 'review_scores_rating', 
-        'review_scores_accuracy', 'review_scores_cleanliness', 'review_scores_checkin', 
-        'review_scores_communication', 'review_scores_location', 'review_scores_value', 
-        'calculated_host_listings_count', 'calculated_host_listings_count_entire_homes', 
-        'calculated_host_listings_count_private_rooms', 
-        'calculated_host_listings_count_shared_rooms', 'reviews_per_month'
-    ]
-    for col in numeric_cols:
-        if col in df.columns:
-            df[col] = df[col].fillna(0)
+    print(f"Loading data from {input_csv}...")
+    try:
+        # Only the kept columns are parsed; the rest of the CSV is skipped
+        keep = set(columns_to_keep)
+        chunks = pd.read_csv(
+            input_csv,
+            usecols=lambda col: col in keep,
+            dtype={col: 'float64' for col in FLOAT_COLUMNS},
+            chunksize=CHUNK_SIZE
+        )
+    except FileNotFoundError:
+        print(f"Error: {input_csv} not found.")
+        print("Please download the 'listings.csv' from Kaggle and place it in this directory.")
+        return
 
-    # 3. Create the RAG document for each listing
-    print("Creating RAG documents...")
-    df['rag_document'] = df.apply(create_rag_document, axis=1)
-    
-    # 4. Save the prepared data to a JSONL file
+    # 2-4. Clean, create RAG documents and save to a JSONL file, one chunk at a time
     # JSONL (JSON Lines) is a great format for this: one JSON object per line.
-    
-    # Select final columns for the output file
-    final_columns = available_columns + ['rag_document', 'price_cleaned']
-    if 'price' in final_columns:
-        final_columns.remove('price') # use price_cleaned instead
-    
-    # Ensure all final columns exist
-    final_df = df[[col for col in final_columns if col in df.columns]]
-    
-    print(f"Saving {len(final_df)} processed listings to {output_jsonl}...")
-    
-    # Convert DataFrame to a list of dictionaries
-    records = final_df.to_dict('records')
-    
-    # Write to JSONL file
-    with open(output_jsonl, 'w', encoding='utf-8') as f:
-        for record in records:
-            json.dump(record, f)
-            f.write('\n')
-            
-    print("\nDone! Your data is prepared.")
+    print(f"Processing listings in chunks of {CHUNK_SIZE} on {PROCESS_WORKERS} worker(s) "
+          f"and saving to {output_jsonl}...")
+    total_records = 0
+    example_record = None
+
+    def write_chunk(f, future):
+        nonlocal total_records, example_record
+        payload, count, first_record = future.result()
+        f.write(payload)
+        total_records += count
+        if example_record is None:
+            example_record = first_record
+        print(f"Processed {total_records} listings...")
+
+    # Chunks are cleaned in parallel worker processes and written back in file order.
+    # orjson writes NaN as null and text as UTF-8; the buffered writer batches the writes.
+    pending = deque()
+    with (
+        chunks,
+        ProcessPoolExecutor(PROCESS_WORKERS, mp_context=multiprocessing.get_context('spawn')) as executor,
+        open(output_jsonl, 'wb', buffering=WRITE_BUFFER_SIZE) as f
+    ):
+        for df in chunks:
+            if len(pending) >= MAX_PENDING_CHUNKS:
+                write_chunk(f, pending.popleft())
+            pending.append(executor.submit(serialize_chunk, df, columns_to_keep))
+        while pending:
+            write_chunk(f, pending.popleft())
+
+    print(f"\nDone! Your data is prepared ({total_records} listings).")
     print(f"See '{output_jsonl}' for the clean data.")
     print("\n--- Example Record ---")
-    if records:
-        print(json.dumps(records[0], indent=2))
+    if example_record:
+        print(json.dumps(example_record, indent=2))
     print("------------------------")
 
 if __name__ == "__main__":
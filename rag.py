@@ -1,8 +1,36 @@
 """
 Core RAG (Retrieval-Augmented Generation) pipeline logic.
 """
+import functools
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+import numpy as np
 from services import EmbeddingModel, VectorStore, GenerativeModel
 
+_WHITESPACE_RE = re.compile(r"\s+")
+
+NO_MATCHES_MESSAGE = "I couldn't find any hotels that match your request. Try rephrasing your search."
+
+# Prompt layout, built once at import; filled in per request with str.format_map
+PROMPT_TEMPLATE = (
+    "You are a helpful Tokyo hotel assistant.\n"
+    "1. Answer the user's question based *only* on the provided context.\n"
+    "2. If the user asks a follow-up question, you can use the chat history to understand it.\n"
+    "3. Do not make up information. Be concise and friendly.\n"
+    "4. After providing the summary/answer, create a new section titled 'Hotels Found:'.\n"
+    "5. In this new section, list the **names** of all hotels you used to answer the question. **CRITICAL:** Format each hotel name as a Markdown link using the URL provided in the context (e.g., `[Hotel Name](URL)`). **Do not list the URL separately.**\n"
+    "6. If no hotels are found, do not display the 'Hotels Found' section."
+    "{history}"
+    "--- CONTEXT ---\n"
+    "{context}"
+    "--- END CONTEXT ---\n\n"
+    "User Question: {query}"
+)
+
 class RagPipeline:
     """
     Encapsulates the logic for the RAG pipeline.
@@ -11,67 +39,118 @@ class RagPipeline:
         self,
         embedding_model: EmbeddingModel,
         vector_store: VectorStore,
-        generative_model: GenerativeModel
+        generative_model: GenerativeModel,
+        embedding_cache_size: int = 1024,
+        response_cache_size: int = 256,
+        filter_workers: int = 4
     ):
         self._embedding_model = embedding_model
         self._vector_store = vector_store
         self._generative_model = generative_model
+        # Repeated queries skip the embedding model; the cache lives as long as the pipeline
+        self._embed_query = functools.lru_cache(maxsize=embedding_cache_size)(self._embed_normalized_query)
+        # Completed answers keyed by prompt digest. The pipeline has a single generative
+        # model, and the prompt embeds the retrieved context, so a hit is never stale.
+        self._response_cache = OrderedDict()
+        self._response_cache_size = response_cache_size
+        self._response_cache_lock = threading.Lock()  # Streamlit sessions share the pipeline
+        # Runs filter extraction alongside the query embedding; shared by all sessions
+        self._executor = ThreadPoolExecutor(max_workers=filter_workers, thread_name_prefix="rag-filters")
 
-    def get_rag_response(self, user_query: str, chat_history: list, match_threshold: float, match_count: int):
-        """
-        Performs the full RAG pipeline and streams the response.
+    @staticmethod
+    def _normalize_query(query: str) -> str:
+        """Lowercases and collapses whitespace so trivially different queries share a cache entry."""
+        return _WHITESPACE_RE.sub(" ", query).strip().lower()
+
+    def _embed_normalized_query(self, normalized_query: str) -> np.ndarray:
+        """Embeds a normalized query, returning a read-only float32 vector that is safe to cache.
+        The vector is scaled to unit length to match the stored embeddings, which are
+        searched by inner product.
         """
-        # 1. Embed the user's query
-        yield "Embedding your query...\n\n"
-        query_embedding = self._embedding_model.embed(user_query)
+        embedding = np.asarray(self._embedding_model.embed(normalized_query), dtype=np.float64)
+        unit = (embedding / (np.linalg.norm(embedding) + 1e-12)).astype(np.float32)
+        unit.flags.writeable = False
+        return unit
 
-        # 1.5 Extract filters (Self-Querying)
-        filters = {}
+    def build_prompt(
+        self,
+        user_query: str,
+        chat_history: list,
+        match_threshold: float,
+        match_count: int,
+        on_status: Callable[[str], None] = lambda label: None
+    ) -> str | None:
+        """
+        Runs retrieval and returns the augmented prompt, or None if no hotels matched.
+        Progress is reported through `on_status` rather than mixed into the response.
+        """
+        # 1. Extract filters (Self-Querying) in the background; it doesn't depend on the embedding
+        filters_future = None
         if hasattr(self._generative_model, 'extract_filters'):
-             yield "Analyzing query for filters...\n\n"
-             filters = self._generative_model.extract_filters(user_query)
-             if filters and (filters.get('min_price') is not None or filters.get('max_price') is not None):
-                 yield f"Applying price filters: {filters}\n\n"
+             on_status("Analyzing query for filters...")
+             filters_future = self._executor.submit(self._generative_model.extract_filters, user_query)
+
+        # 1.5 Embed the user's query while the filters are extracted
+        on_status("Embedding your query...")
+        query_embedding = self._embed_query(self._normalize_query(user_query))
+
+        filters = filters_future.result() if filters_future else {}
+        if filters and (filters.get('min_price') is not None or filters.get('max_price') is not None):
+            on_status(f"Applying price filters: {filters}")
 
         # 2. Search for similar documents
-        yield "Searching for relevant hotels...\n\n"
+        on_status("Searching for relevant hotels...")
         # Pass filters to search
         matches = self._vector_store.search(query_embedding, match_threshold, match_count, filters=filters)
 
         if not matches:
-            yield "I couldn't find any hotels that match your request. Try rephrasing your search."
-            return
+            return None
 
-        # 3. Augment: Create the context
-        rag_context = "--- CONTEXT ---\n"
-        for i, match in enumerate(matches):
-            rag_context += f"Result {i+1}:\n{match['rag_document']}\nURL: {match['listing_url']}\n\n"
-        rag_context += "--- END CONTEXT ---\n\n"
-
-        # Build the full prompt with history
-        prompt_with_history = (
-            "You are a helpful Tokyo hotel assistant.\n"
-            "1. Answer the user's question based *only* on the provided context.\n"
-            "2. If the user asks a follow-up question, you can use the chat history to understand it.\n"
-            "3. Do not make up information. Be concise and friendly.\n"
-            "4. After providing the summary/answer, create a new section titled 'Hotels Found:'.\n"
-            "5. In this new section, list the **names** of all hotels you used to answer the question. **CRITICAL:** Format each hotel name as a Markdown link using the URL provided in the context (e.g., `[Hotel Name](URL)`). **Do not list the URL separately.**\n"
-            "6. If no hotels are found, do not display the 'Hotels Found' section."
+        # 3. Augment: Create the context (joined once rather than grown in the loop)
+        rag_context = "".join(
+            f"Result {i+1}:\n{match['rag_document']}\nURL: {match['listing_url']}\n\n"
+            for i, match in enumerate(matches)
         )
 
         # Add chat history to the prompt
+        history = ""
         if chat_history:
-            prompt_with_history += "--- CHAT HISTORY ---\n"
-            for message in chat_history:
-                prompt_with_history += f"{message['role']}: {message['content']}\n"
-            prompt_with_history += "--- END CHAT HISTORY ---\n\n"
+            history = "".join([
+                "--- CHAT HISTORY ---\n",
+                *(f"{message['role']}: {message['content']}\n" for message in chat_history),
+                "--- END CHAT HISTORY ---\n\n"
+            ])
+
+        # Build the full prompt with history
+        prompt_with_history = PROMPT_TEMPLATE.format_map(
+            {'history': history, 'context': rag_context, 'query': user_query}
+        )
+        return prompt_with_history
 
-        prompt_with_history += rag_context
-        prompt_with_history += "User Question: " + user_query
+    def stream_tokens(self, prompt: str):
+        """
+        Streams only the generated answer text for a prompt from `build_prompt`.
+        Answers to a repeated prompt are served from the cache in one piece.
+        """
+        key = hashlib.blake2b(prompt.encode("utf-8"), digest_size=16).digest()
+        with self._response_cache_lock:
+            cached = self._response_cache.get(key)
+            if cached is not None:
+                self._response_cache.move_to_end(key)
+        if cached is not None:
+            yield cached
+            return
 
         # 4. Generate: Stream the response
-        yield "Found matches! Asking the AI...\n\n"
-        response_stream = self._generative_model.generate(prompt_with_history, stream=True)
-        
+        response_stream = self._generative_model.generate(prompt, stream=True)
+
+        chunks = []
         for chunk in response_stream:
+            chunks.append(chunk.text)
             yield chunk.text
+
+        # Only cache answers that streamed to completion
+        with self._response_cache_lock:
+            self._response_cache[key] = "".join(chunks)
+            if len(self._response_cache) > self._response_cache_size:
+                self._response_cache.popitem(last=False)
@@ -1,14 +1,48 @@
 """
 Abstractions and implementations for external services.
 """
+import functools
+import hashlib
 import logging
+import random
+import re
+import sqlite3
+import threading
 import time
 from abc import ABC, abstractmethod
-import psycopg2
+from collections import OrderedDict
+import numpy as np
 import google.generativeai as genai
 import ollama
+import orjson
 from psycopg2.extras import RealDictCursor
-from config import DB_HOST, DB_NAME, DB_USER, DB_PASSWORD, DB_PORT, GOOGLE_API_KEY, EMBEDDING_MODEL_NAME
+from psycopg2.pool import ThreadedConnectionPool
+from config import (
+    DB_HOST, DB_NAME, DB_USER, DB_PASSWORD, DB_PORT, DB_POOL_MIN_CONNECTIONS,
+    DB_POOL_MAX_CONNECTIONS, GOOGLE_API_KEY,
+    EMBEDDING_MODEL_NAME, EMBEDDING_OPTIONS, OLLAMA_HOST, OLLAMA_TIMEOUT,
+    EMBEDDING_CACHE_MAX_ENTRIES, SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL, FILTER_CACHE_SIZE
+)
+
+SEARCH_STATEMENT_NAME = 'match_properties'  # Prepared once per pooled connection
+# Structured output for filter extraction, so Gemini replies with bare JSON of this shape
+FILTER_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": {
+        "type": "object",
+        "properties": {
+            "min_price": {"type": "number", "nullable": True},
+            "max_price": {"type": "number", "nullable": True}
+        }
+    }
+}
+# Anything that could express a price constraint: digits, currency signs or budget words.
+# Queries without one skip the filter extraction call entirely.
+_PRICE_HINT_RE = re.compile(
+    r'\d|[$¥€£円]|\b(?:under|below|over|above|less|more|max|min|between|within|cheap|budget|'
+    r'afford|expensive|pric|cost|yen|jpy|usd|dollar|luxur|thousand|hundred|grand|k\b)',
+    re.IGNORECASE
+)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -18,14 +52,20 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 class EmbeddingModel(ABC):
     """Abstract base class for an embedding model."""
     @abstractmethod
-    def embed(self, text: str) -> list[float]:
-        """Embeds a string of text and returns the embedding."""
+    def embed(self, text: str) -> np.ndarray:
+        """Embeds a string of text and returns the embedding as a float32 vector."""
         pass
 
+    def embed_batch(self, texts: list[str]) -> np.ndarray:
+        """Embeds several texts, returning a float32 array with one row per text in order.
+        Implementations that can embed many texts per request should override this.
+        """
+        return np.array([self.embed(text) for text in texts], dtype=np.float32)
+
 class VectorStore(ABC):
     """Abstract base class for a vector store."""
     @abstractmethod
-    def search(self, embedding: list[float], match_threshold: float, match_count: int, filters: dict = None) -> list[dict]:
+    def search(self, embedding: np.ndarray, match_threshold: float, match_count: int, filters: dict = None) -> list[dict]:
         """Searches for similar documents in the vector store."""
         pass
 
@@ -47,63 +87,205 @@ class OllamaEmbeddingModel(EmbeddingModel):
     """Implementation of the embedding model using Ollama."""
     def __init__(self, model_name: str = EMBEDDING_MODEL_NAME):
         self._model_name = model_name
+        # Kept for the model's lifetime so queries reuse a keep-alive connection
+        self._client = ollama.Client(host=OLLAMA_HOST, timeout=OLLAMA_TIMEOUT)
         logging.info(f"Initialized OllamaEmbeddingModel with model: {model_name}")
 
-    def embed(self, text: str) -> list[float]:
+    def embed(self, text: str) -> np.ndarray:
         """Embeds text using the Ollama model."""
         logging.info(f"Embedding text with Ollama: '{text[:50]}...'")
         try:
             # Truncate to avoid exceeding 512 token limit. Reduced to 500 chars.
             truncated_text = text[:500]
-            response = ollama.embeddings(model=self._model_name, prompt=truncated_text)
+            response = self._client.embeddings(model=self._model_name, prompt=truncated_text, options=EMBEDDING_OPTIONS)
             logging.info("Successfully embedded text with Ollama.")
-            return response["embedding"]
+            # float32 matches the stored vectors at a fraction of a list of Python floats
+            return np.asarray(response["embedding"], dtype=np.float32)
         except Exception as e:
             logging.error(f"Error embedding query with Ollama: {e}")
             raise RuntimeError(f"Error embedding query with Ollama: {e}") from e
 
+    def embed_batch(self, texts: list[str]) -> np.ndarray:
+        """Embeds all texts with a single Ollama request."""
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        logging.info(f"Embedding {len(texts)} texts with Ollama...")
+        try:
+            # Same truncation as embed()
+            truncated_texts = [text[:500] for text in texts]
+            response = self._client.embed(model=self._model_name, input=truncated_texts, options=EMBEDDING_OPTIONS)
+            logging.info("Successfully embedded batch with Ollama.")
+            return np.asarray(response["embeddings"], dtype=np.float32)
+        except Exception as e:
+            logging.error(f"Error embedding batch with Ollama: {e}")
+            raise RuntimeError(f"Error embedding batch with Ollama: {e}") from e
+
+class CachedEmbeddingModel(EmbeddingModel):
+    """Wraps an embedding model with a persistent SQLite cache of its embeddings.
+    Entries are keyed by sha256 of the model name and text, so switching models
+    never serves a stale vector. Past `max_entries` the oldest stored entries are evicted.
+    """
+    def __init__(self, model: EmbeddingModel, model_name: str, path: str,
+                 max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES):
+        self._model = model
+        self._model_name = model_name
+        self._max_entries = max_entries
+        # One connection shared by all sessions; the lock serializes access to it
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vector BLOB NOT NULL)")
+        self._conn.commit()
+        self._lock = threading.Lock()
+        logging.info(f"Initialized embedding cache at {path}")
+
+    def _key(self, text: str) -> bytes:
+        return hashlib.sha256(f"{self._model_name}\0{text}".encode()).digest()
+
+    def _lookup(self, keys: list[bytes]) -> dict[bytes, np.ndarray]:
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(keys))})", keys
+            ).fetchall()
+        return {key: np.frombuffer(vector, dtype=np.float32) for key, vector in rows}
+
+    def _store(self, keys: list[bytes], embeddings) -> None:
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, np.asarray(embedding, dtype=np.float32).tobytes()) for key, embedding in zip(keys, embeddings)]
+            )
+            # Rowids grow with each insert, so this keeps the newest max_entries rows
+            # without counting the table
+            self._conn.execute(
+                "DELETE FROM embeddings WHERE rowid <= (SELECT max(rowid) FROM embeddings) - ?",
+                (self._max_entries,)
+            )
+            self._conn.commit()
+
+    def embed(self, text: str) -> np.ndarray:
+        """Returns the cached embedding, embedding and storing it on a miss."""
+        return self.embed_batch([text])[0]
+
+    def embed_batch(self, texts: list[str]) -> np.ndarray:
+        """Embeds only the texts missing from the cache, with one call to the wrapped model."""
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        keys = [self._key(text) for text in texts]
+        cached = self._lookup(list(set(keys)))
+        missing = list({key: text for key, text in zip(keys, texts) if key not in cached}.items())
+        if missing:
+            embeddings = self._model.embed_batch([text for _, text in missing])
+            self._store([key for key, _ in missing], embeddings)
+            cached.update((key, np.asarray(embedding, dtype=np.float32)) for (key, _), embedding in zip(missing, embeddings))
+        else:
+            logging.info(f"Served {len(texts)} embedding(s) from the cache.")
+        return np.array([cached[key] for key in keys], dtype=np.float32)
+
+
 class PostgresVectorStore(VectorStore):
     """Implementation of the vector store using Local PostgreSQL + pgvector."""
-    def __init__(self):
+    def __init__(self, cache_size: int = SEARCH_CACHE_SIZE, cache_ttl: float = SEARCH_CACHE_TTL):
         logging.info("Initializing PostgresVectorStore...")
+        # Results keyed by query vector digest and search parameters, stored with the
+        # monotonic time they were fetched. The listings only change on re-ingestion,
+        # which runs in another process, so entries expire after `cache_ttl` seconds.
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        self._cache_ttl = cache_ttl
+        self._cache_lock = threading.Lock()  # Streamlit sessions share the store
         try:
             self._connection_params = {
                 "host": DB_HOST,
                 "database": DB_NAME,
                 "user": DB_USER,
                 "password": DB_PASSWORD,
-                "port": DB_PORT
+                "port": DB_PORT,
+                # Pooled connections are long-lived, so TCP keepalives stop idle NATs and
+                # firewalls from silently dropping it between queries
+                "connect_timeout": 10,
+                "keepalives": 1,
+                "keepalives_idle": 30,
+                "keepalives_interval": 10,
+                "keepalives_count": 3
             }
-            # Test connection
-            conn = psycopg2.connect(**self._connection_params)
-            conn.close()
+            # Connections are opened up front and shared by all sessions, so queries skip
+            # the connection setup. Each one prepares the search statement on first use.
+            self._pool = ThreadedConnectionPool(DB_POOL_MIN_CONNECTIONS, DB_POOL_MAX_CONNECTIONS, **self._connection_params)
+            self._prepared = set()
             logging.info("PostgresVectorStore initialized successfully (connection test passed).")
         except Exception as e:
             logging.error(f"Failed to connect to PostgreSQL: {e}")
             raise RuntimeError("Could not connect to database") from e
 
-    def search(self, embedding: list[float], match_threshold: float, match_count: int, filters: dict = None) -> list[dict]:
+    def _get_connection(self):
+        """Takes a connection from the pool, preparing the search statement on it if needed."""
+        conn = self._pool.getconn()
+        if conn not in self._prepared:
+            try:
+                conn.autocommit = True  # Read-only searches; don't hold a transaction open
+                with conn.cursor() as cur:
+                    cur.execute(
+                        f"PREPARE {SEARCH_STATEMENT_NAME} (vector, float, int, float, float) AS "
+                        "SELECT * FROM match_properties_filtered($1, $2, $3, $4, $5)"
+                    )
+            except Exception:
+                # The caller never sees this connection, so it must go back to the pool here
+                self._pool.putconn(conn, close=True)
+                raise
+            self._prepared.add(conn)
+        return conn
+
+    def _release_connection(self, conn, broken: bool = False):
+        """Returns a connection to the pool, closing it instead if it failed."""
+        self._pool.putconn(conn, close=broken)
+        if conn.closed:  # Also closed by the pool when it holds more than the minimum idle
+            self._prepared.discard(conn)
+
+    def clear_cache(self):
+        """Drops all cached search results, e.g. after the listings are re-ingested."""
+        with self._cache_lock:
+            self._cache.clear()
+
+    def search(self, embedding: np.ndarray, match_threshold: float, match_count: int, filters: dict = None) -> list[dict]:
         """Searches for similar properties using the match_properties_filtered function."""
         retries = 3
-        delay = 2
         
         # Prepare arguments for the SQL function
         min_price = filters.get('min_price') if filters else None
         max_price = filters.get('max_price') if filters else None
+
+        # The column stores float4, so the query is sent (and cached) at that precision
+        query_vector = np.asarray(embedding, dtype=np.float32)
+        key = (
+            hashlib.blake2b(query_vector.tobytes(), digest_size=16).digest(),
+            match_threshold, match_count, min_price, max_price
+        )
+        with self._cache_lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                fetched_at, cached = cached
+                if time.monotonic() - fetched_at < self._cache_ttl:
+                    self._cache.move_to_end(key)
+                else:
+                    del self._cache[key]
+                    cached = None
+        if cached is not None:
+            logging.info(f"Serving {len(cached)} matches from the search cache.")
+            return list(cached)
         
         logging.info(f"Searching Postgres with filters: min={min_price}, max={max_price}")
         
         for i in range(retries):
             conn = None
             try:
-                conn = psycopg2.connect(**self._connection_params)
+                conn = self._get_connection()
                 with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                    # Convert list to string format for pgvector casting
-                    embedding_str = f"[{','.join(map(str, embedding))}]"
+                    # Convert the vector to string format for pgvector casting. 9 significant
+                    # digits round-trip float4 exactly at ~2/3 the payload
+                    embedding_str = f"[{','.join(f'{x:.9g}' for x in query_vector.tolist())}]"
                     
-                    # Call the stored procedure
+                    # Execute the prepared call to the stored procedure
                     # match_properties_filtered(query_embedding, match_threshold, match_count, min_price, max_price)
-                    cur.callproc('match_properties_filtered', (
+                    cur.execute(f"EXECUTE {SEARCH_STATEMENT_NAME} (%s, %s, %s, %s, %s)", (
                         embedding_str,
                         match_threshold,
                         match_count,
@@ -111,26 +293,35 @@ class PostgresVectorStore(VectorStore):
                         max_price
                     ))
                     results = cur.fetchall()
-                    
-                logging.info(f"Postgres search successful, found {len(results)} matches.")
-                return results
 
             except Exception as e:
                 logging.warning(f"Postgres search attempt {i+1}/{retries} failed: {e}")
+                if conn is not None:
+                    self._release_connection(conn, broken=True)
                 if i < retries - 1:
-                    time.sleep(delay)
-                else:
-                    logging.error("All Postgres search attempts failed.")
-                    raise RuntimeError(f"Error searching database: {e}") from e
-            finally:
-                if conn:
-                    conn.close()
+                    # Jittered exponential backoff: 0.25-0.5s, then 0.5-0.75s. A dropped pooled
+                    # connection is already replaced, so the retry rarely needs to wait long.
+                    time.sleep(0.25 * 2 ** i + random.random() * 0.25)
+                    continue
+                logging.error("All Postgres search attempts failed.")
+                raise RuntimeError(f"Error searching database: {e}") from e
+
+            # Released outside the try, so a failure after this can't return it twice
+            self._release_connection(conn)
+            logging.info(f"Postgres search successful, found {len(results)} matches.")
+            with self._cache_lock:
+                self._cache[key] = (time.monotonic(), results)
+                if len(self._cache) > self._cache_size:
+                    self._cache.popitem(last=False)
+            return list(results)
 
 class GeminiGenerativeModel(GenerativeModel):
     """Implementation of the generative model using Google Gemini."""
-    def __init__(self, model_name: str):
+    def __init__(self, model_name: str, filter_cache_size: int = FILTER_CACHE_SIZE):
         genai.configure(api_key=GOOGLE_API_KEY)
         self._model = genai.GenerativeModel(model_name)
+        # Repeated queries reuse their extracted filters; failed extractions are not cached
+        self._extract_filters_cached = functools.lru_cache(maxsize=filter_cache_size)(self._extract_filters)
         logging.info(f"Initialized GeminiGenerativeModel with model: {model_name}")
 
     def generate(self, context: str, stream: bool = False):
@@ -149,9 +340,20 @@ class GeminiGenerativeModel(GenerativeModel):
         Extracts structured filters (min_price, max_price) from the query using Gemini.
         Returns a dictionary like {'min_price': 100, 'max_price': 500} or empty dict if none.
         """
-        import json
-        import re
+        if not _PRICE_HINT_RE.search(query):
+            logging.info("No price hints in query, skipping filter extraction.")
+            return {}
+
+        try:
+            # Whitespace and case don't change a price constraint, so they share an entry
+            # Callers get their own copy of the cached result
+            return dict(self._extract_filters_cached(" ".join(query.split()).lower()))
+        except Exception as e:
+            logging.error(f"Error extraction filters: {e}")
+            return {}
 
+    def _extract_filters(self, query: str) -> dict:
+        """Asks Gemini for the query's price filters, raising if the reply can't be parsed."""
         prompt = f"""
         Analyze the following user query for hotel searches. 
         Extract any price constraints. 
@@ -164,20 +366,109 @@ class GeminiGenerativeModel(GenerativeModel):
         JSON:
         """
         
-        try:
-            logging.info("Extracting filters with Gemini...")
-            response = self._model.generate_content(prompt)
-            text_response = response.text.strip()
-            
-            # Remove potential markdown code blocks ```json ... ```
-            text_response = re.sub(r'```json\s*', '', text_response)
-            text_response = re.sub(r'```', '', text_response)
-            
-            filters = json.loads(text_response)
-            
-            logging.info(f"Extracted filters: {filters}")
+        logging.info("Extracting filters with Gemini...")
+        response = self._model.generate_content(prompt, generation_config=FILTER_GENERATION_CONFIG)
+        filters = orjson.loads(response.text)
+        
+        logging.info(f"Extracted filters: {filters}")
+        return filters
+
+class RegexFilterExtractor(GenerativeModel):
+    """Wraps a generative model, answering common price phrasings ("under 10000 yen",
+    "between ¥8k and ¥15k", "budget 5000-9000", "1万円以下") with regexes so those queries
+    skip the LLM call. A number only counts as a price when it carries a currency marker
+    or multiplier, or sits next to a price word; guest counts, dates and floors like
+    "up to 4 adults" go to the wrapped model, as do generation and anything else the
+    patterns miss.
+    """
+    # A price: optional currency sign, digits with optional separators, optional multiplier
+    # and currency word. Not a price when followed by a unit like minutes or guests.
+    # Groups per amount: sign, number, multiplier, currency word.
+    _AMOUNT = (
+        r'([$¥€£])?\s*(\d[\d,]*(?:\.\d+)?)\s*(k\b|万|thousand\b|man\b)?\s*(円|yen\b|jpy\b)?'
+        r'(?!\s*(?:\d|min|mins|minutes?|hours?|hrs?|km|m\b|meters?|people|persons?|guests?|'
+        r'nights?|days?|weeks?|beds?|bedrooms?|rooms?|stars?|reviews?|walk|stops?|stations?|'
+        r'adults?|kids?|child(?:ren)?|ppl|rating))'
+    )
+    _AMOUNT_GROUPS = 4
+    # Unmarked numbers are accepted when one of these is part of the match or directly
+    # next to it ("budget 9000", "9000 per night"), not just somewhere in the query
+    _PRICE_WORD = r'(?:\b(?:price[sd]?|pricing|budget|costs?|per night|a night|nightly)\b|/\s*night\b)'
+    _PRICE_WORD_RE = re.compile(_PRICE_WORD, re.IGNORECASE)
+    _PRICE_WORD_BEFORE_RE = re.compile(_PRICE_WORD + r'\s*(?:of|is|:)?\s*$', re.IGNORECASE)
+    _PRICE_WORD_AFTER_RE = re.compile(r'\s*' + _PRICE_WORD, re.IGNORECASE)  # Used with .match()
+    _RANGE_RES = [
+        re.compile(r'\bbetween\s*' + _AMOUNT + r'\s*(?:and|to|-|~)\s*' + _AMOUNT, re.IGNORECASE),
+        re.compile(r'\bfrom\s*' + _AMOUNT + r'\s*(?:to|-|~)\s*' + _AMOUNT, re.IGNORECASE),
+        re.compile(_AMOUNT + r'\s*(?:-|~|to)\s*' + _AMOUNT, re.IGNORECASE),
+    ]
+    _MAX_RES = [
+        re.compile(
+            r'\b(?:under|below|less than|cheaper than|lower than|max(?:imum)?|up to|at most|'
+            r'no more than|not more than|within|budget(?: of| is)?)\s*(?:a |an |of )?' + _AMOUNT,
+            re.IGNORECASE
+        ),
+        re.compile(_AMOUNT + r'\s*(?:or less|or under|or below|max\b|以下|以内|未満)', re.IGNORECASE),
+    ]
+    _MIN_RES = [
+        re.compile(
+            r'\b(?:over|above|more than|at least|min(?:imum)?|no less than|starting at)\s*' + _AMOUNT,
+            re.IGNORECASE
+        ),
+        re.compile(_AMOUNT + r'\s*(?:or more|or above|\+|以上)', re.IGNORECASE),
+    ]
+
+    def __init__(self, model: GenerativeModel):
+        self._model = model
+
+    @staticmethod
+    def _to_price(number: str, multiplier: str | None) -> float:
+        value = float(number.replace(',', ''))
+        if multiplier:
+            value *= 10_000 if multiplier.lower() in ('万', 'man') else 1_000
+        return value
+
+    def _price_match(self, pattern: re.Pattern, query: str) -> re.Match | None:
+        """Returns the first match of `pattern` that reads as a price, or None."""
+        for match in pattern.finditer(query):
+            groups = match.groups()
+            amounts = [groups[i:i + self._AMOUNT_GROUPS] for i in range(0, len(groups), self._AMOUNT_GROUPS)]
+            if any(sign or multiplier or currency for sign, _, multiplier, currency in amounts):
+                return match
+            if (self._PRICE_WORD_RE.search(match.group(0))
+                    or self._PRICE_WORD_BEFORE_RE.search(query, 0, match.start())
+                    or self._PRICE_WORD_AFTER_RE.match(query, match.end())):
+                return match
+        return None
+
+    def generate(self, context: str, stream: bool = False):
+        return self._model.generate(context, stream=stream)
+
+    def extract_filters(self, query: str) -> dict:
+        """Parses price filters locally, falling back to the wrapped model when no pattern
+        matches a price or the bounds it finds are inverted.
+        """
+        filters = None
+        for pattern in self._RANGE_RES:
+            match = self._price_match(pattern, query)
+            if match:
+                filters = {'min_price': self._to_price(*match.group(2, 3)), 'max_price': self._to_price(*match.group(6, 7))}
+                break
+
+        if filters is None:
+            bounds = {}
+            for key, patterns in (('max_price', self._MAX_RES), ('min_price', self._MIN_RES)):
+                for pattern in patterns:
+                    match = self._price_match(pattern, query)
+                    if match:
+                        bounds[key] = self._to_price(*match.group(2, 3))
+                        break
+            if bounds:
+                filters = {'min_price': bounds.get('min_price'), 'max_price': bounds.get('max_price')}
+
+        if filters and (filters['min_price'] is None or filters['max_price'] is None
+                        or filters['min_price'] <= filters['max_price']):
+            logging.info(f"Extracted filters locally: {filters}")
             return filters
-            
-        except Exception as e:
-            logging.error(f"Error extraction filters: {e}")
-            return {}
+
+        return self._model.extract_filters(query)
@@ -0,0 +1,62 @@
+import unittest
+
+from services import GenerativeModel, RegexFilterExtractor
+
+
+class RecordingModel(GenerativeModel):
+    """Stands in for Gemini, recording the queries the regexes hand over."""
+    def __init__(self):
+        self.queries = []
+
+    def generate(self, context: str, stream: bool = False):
+        raise NotImplementedError
+
+    def extract_filters(self, query: str) -> dict:
+        self.queries.append(query)
+        return {}
+
+
+class RegexFilterExtractorTest(unittest.TestCase):
+    def test_price_phrasings_are_parsed_locally(self):
+        cases = [
+            ("hotel under 10000 yen", {'min_price': None, 'max_price': 10000}),
+            ("between ¥8k and ¥15k", {'min_price': 8000, 'max_price': 15000}),
+            ("budget 5000-9000", {'min_price': 5000, 'max_price': 9000}),
+            ("1万円以下", {'min_price': None, 'max_price': 10000}),
+            ("over 12000 per night", {'min_price': 12000, 'max_price': None}),
+            ("2 kids under 10, under ¥8000", {'min_price': None, 'max_price': 8000}),
+            ("2-3 adults, budget 9000 yen", {'min_price': None, 'max_price': 9000}),
+            ("2 to 3 adults, price under 9000", {'min_price': None, 'max_price': 9000}),
+            ("1-2 adults budget 9000", {'min_price': None, 'max_price': 9000}),
+            ("at least 4.8 rating, price under 9000", {'min_price': None, 'max_price': 9000}),
+            ("under 9000 per night", {'min_price': None, 'max_price': 9000}),
+        ]
+        for query, expected in cases:
+            with self.subTest(query=query):
+                model = RecordingModel()
+                self.assertEqual(RegexFilterExtractor(model).extract_filters(query), expected)
+                self.assertEqual(model.queries, [])
+
+    def test_non_prices_and_inverted_bounds_go_to_the_model(self):
+        queries = [
+            "sleeps up to 6",
+            "up to 4 adults",
+            "2 to 3 adults",
+            "from 10 to 14 december",
+            "2024-05-01 to 2024-05-05",
+            "2 kids under 10",
+            "floor 20 or above",
+            "minimum stay 1 night max 3",
+            "between ¥15000 and ¥8000",
+            "2-3 adults near a park with a good price",
+            "max 3 nights, good price",
+        ]
+        for query in queries:
+            with self.subTest(query=query):
+                model = RecordingModel()
+                self.assertEqual(RegexFilterExtractor(model).extract_filters(query), {})
+                self.assertEqual(model.queries, [query])
+
+
+if __name__ == '__main__':
+    unittest.main()